@@ -7,17 +7,29 @@
 # nor does it submit to any jurisdiction.
 #
 
+from .broker.AsyncBroker import AsyncBroker
 from .broker.Broker import Broker
 from .broker.Environment import Environment
-from .broker.Request import Request, Status
+from .broker.Journal import Journal
+from .broker.Recorder import Recorder
+from .broker.Request import Request, RequestCanceled, Status
+from .broker.Tracer import Tracer
+from .dispatcher.Admission import Admission, QueueFull
 from .expressions.FunctionFactory import FunctionFactory
 
 __version__ = "0.0.1"
 
 __all__ = [
+    "Admission",
+    "AsyncBroker",
     "Broker",
     "Environment",
     "FunctionFactory",
+    "Journal",
+    "QueueFull",
+    "Recorder",
     "Request",
+    "RequestCanceled",
     "Status",
+    "Tracer",
 ]
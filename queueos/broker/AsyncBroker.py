@@ -0,0 +1,82 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import asyncio
+
+from queueos.broker.Broker import Broker
+from queueos.dispatcher.AsyncDispatcher import AsyncDispatcher
+from queueos.qos.QoS import QoS
+
+
+class AsyncBroker(Broker):
+    """The asyncio version of the Broker. Requests are run as tasks of the event
+    loop from which start() is called, instead of by worker threads."""
+
+    def __init__(
+        self,
+        rules,
+        max_concurrency,
+        environment,
+        journal=None,
+        queue=None,
+        metrics=None,
+        tracer=None,
+        recorder=None,
+        admission=None,
+        qos_class=QoS,
+    ):
+        super().__init__(
+            rules,
+            max_concurrency,
+            environment,
+            journal=journal,
+            queue=queue,
+            metrics=metrics,
+            tracer=tracer,
+            recorder=recorder,
+            admission=admission,
+            qos_class=qos_class,
+        )
+
+    def create_dispatcher(self, max_concurrency, environment, autoscaler, queue):
+        assert autoscaler is None
+        return AsyncDispatcher(
+            max_concurrency,
+            self.qos,
+            self.qos,
+            environment,
+            queue=queue,
+            metrics=self.metrics,
+            admission=self.admission,
+        )
+
+    def start(self):
+        return self.dispatcher.start()
+
+    def enqueue(self, request, not_before=None, policy=None):
+        """Queue a request. Returns an asyncio future resolved with the result
+        of the request, or its error. The 'block' policy of an Admission would
+        block the event loop, use enqueue_async() instead."""
+        future = super().enqueue(request, not_before, policy)
+        return asyncio.wrap_future(future, loop=self.dispatcher.loop)
+
+    def enqueue_many(self, requests, policy=None):
+        """Queue several requests in a single step. Returns the list of their
+        asyncio futures."""
+        futures = super().enqueue_many(requests, policy)
+        return [asyncio.wrap_future(f, loop=self.dispatcher.loop) for f in futures]
+
+    def set_max_concurrency(self, max_concurrency):
+        self.set_number_of_workers(max_concurrency)
+
+    async def wait_for_all_requests(self):
+        await self.dispatcher.wait_for_all_requests()
+
+    async def shutdown(self):
+        await self.dispatcher.shutdown()
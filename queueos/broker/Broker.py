@@ -7,6 +7,10 @@
 # nor does it submit to any jurisdiction.
 #
 
+import asyncio
+
+from queueos.broker.Metrics import Metrics
+from queueos.dispatcher.Admission import BLOCK
 from queueos.dispatcher.Dispatcher import Dispatcher
 from queueos.qos.QoS import QoS
 
@@ -14,18 +18,100 @@ from queueos.qos.QoS import QoS
 class Broker:
     """This is the Broker itself. Just a wrapper around a Dispatcher and a QoS"""
 
-    def __init__(self, rules, number_of_workers, environment):
-        self.qos = QoS(rules, environment)
-        self.dispatcher = Dispatcher(number_of_workers, self.qos, self.qos, environment)
+    def __init__(
+        self,
+        rules,
+        number_of_workers,
+        environment,
+        autoscaler=None,
+        journal=None,
+        counters=None,
+        queue=None,
+        metrics=None,
+        tracer=None,
+        recorder=None,
+        admission=None,
+        qos_class=QoS,
+    ):
+        # Metrics are always recorded, see metrics_text()
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Optional bounds on the queue, see Admission
+        self.admission = admission
+        # The scheduling policy, e.g. FairShareQoS
+        self.qos = qos_class(rules, environment, counters, metrics=self.metrics)
+        self.dispatcher = self.create_dispatcher(
+            number_of_workers,
+            environment,
+            autoscaler,
+            queue,
+        )
+        self.qos.attach(self.dispatcher)
+        self.metrics.attach(self.dispatcher, self.qos)
+
+        # Optional trace of the scheduling decisions
+        self.tracer = tracer
+        if tracer is not None:
+            tracer.attach(self.dispatcher, self.qos, environment)
+
+        # Optional capture of the workload, see Replayer
+        self.recorder = recorder
+        if recorder is not None:
+            self.dispatcher.add_listener(recorder)
 
         self.qos.dump()
 
+        # Re-populate the queue with the requests that were known when the
+        # broker stopped, with their original start times
+        self.journal = journal
+        if journal is not None:
+            self.dispatcher.add_listener(journal)
+            for request in journal.replay():
+                self.dispatcher.enqueue(request)
+
+    def create_dispatcher(self, number_of_workers, environment, autoscaler, queue):
+        return Dispatcher(
+            number_of_workers,
+            self.qos,
+            self.qos,
+            environment,
+            autoscaler,
+            queue,
+            self.metrics,
+            self.admission,
+        )
+
     def __del__(self):
         self.dispatcher.set_number_of_workers(0)
 
-    def enqueue(self, request):
+    def enqueue(self, request, not_before=None, policy=None):
+        """Queue a request. If 'not_before' is given, the request is only queued
+        at that time. Returns a concurrent.futures.Future resolved with the
+        result of the request, or its error. If the broker has an Admission,
+        'policy' overrides its policy for this request."""
         assert request is not None
-        self.dispatcher.enqueue(request)
+        if not_before is None:
+            self.dispatcher.enqueue(request, policy)
+        else:
+            self.dispatcher.enqueue_at(request, not_before)
+        return request.future
+
+    def enqueue_many(self, requests, policy=None):
+        """Queue several requests in a single step. Returns the list of their
+        futures."""
+        requests = list(requests)
+        assert all(request is not None for request in requests)
+        self.dispatcher.enqueue_many(requests, policy)
+        return [request.future for request in requests]
+
+    async def enqueue_async(self, request):
+        """Queue a request from a coroutine, waiting for room in the queue
+        without blocking the event loop. Returns an asyncio future resolved
+        with the result of the request, or its error. Raises QueueFull if the
+        timeout of the Admission expires."""
+        assert request is not None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.dispatcher.enqueue, request, BLOCK)
+        return asyncio.wrap_future(request.future)
 
     def set_number_of_workers(self, number_of_workers):
         self.dispatcher.set_number_of_workers(number_of_workers)
@@ -45,6 +131,11 @@ class Broker:
     def resume(self):
         self.dispatcher.resume()
 
+    def metrics_text(self):
+        """Returns the metrics of the broker in the Prometheus text format. Unlike
+        status(), it does not go through the rules of each request."""
+        return self.metrics.expose()
+
     def status(self, out=print):
         self.qos.status(self.dispatcher.known_requests, out)
 
@@ -69,4 +69,4 @@ class Environment:
 
         for o in self._observers:
             # Notify in a thread so we don't create deadlocks
-            threading.Thread(target=notify, args=(o,), daemon=True)
+            threading.Thread(target=notify, args=(o,), daemon=True).start()
@@ -0,0 +1,147 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import itertools
+import pickle
+import sqlite3
+import threading
+
+from queueos.broker.Request import Status, reserve_ids
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    key INTEGER PRIMARY KEY,
+    id INTEGER NOT NULL,
+    start REAL NOT NULL,
+    status TEXT NOT NULL,
+    payload BLOB NOT NULL
+)
+"""
+
+INSERT = "INSERT INTO requests (key, id, start, status, payload) VALUES (?, ?, ?, ?, ?)"
+UPDATE = "UPDATE requests SET status = ? WHERE key = ?"
+DELETE = "DELETE FROM requests WHERE key = ?"
+
+
+class Journal:
+    """This class records the requests known to a Dispatcher in an SQLite
+    database in WAL mode, so that the queue can be rebuilt when the Broker is
+    restarted. It is registered as a listener of the Dispatcher: a request is
+    pickled when it is first queued, its status is updated when it starts
+    or is queued again, and it is deleted when it ends.
+
+    The events are appended to a list and written by a background thread.
+    All the events that arrive while a transaction is being committed are
+    written in the next transaction (group commit), so the Dispatcher never
+    waits for the disk. Call flush() to wait until the events recorded so far
+    are durable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+        (last,) = self.db.execute("SELECT MAX(key) FROM requests").fetchone()
+        self.keys = itertools.count((last or 0) + 1)
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.recorded = 0
+        self.written = 0
+        self.closed = False
+
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def replay(self):
+        """Returns the requests recorded in the journal, in the order they were
+        first queued. Requests that were active when the Broker stopped are
+        returned too, as their workers died with it; they must be run again.
+        The requests keep their id and their original start time."""
+        requests = []
+        last = -1
+        for key, payload in self.db.execute(
+            "SELECT key, payload FROM requests ORDER BY key"
+        ):
+            request = pickle.loads(payload)
+            request.journal_key = key
+            request.status = Status.UNKNOWN
+            last = max(last, request.id)
+            requests.append(request)
+
+        reserve_ids(last)
+        return requests
+
+    def _record(self, sql, params):
+        with self.condition:
+            self.pending.append((sql, params))
+            self.recorded += 1
+            self.condition.notify_all()
+
+    def notify_enqueue_of_request(self, request):
+        key = getattr(request, "journal_key", None)
+        if key is None:
+            request.journal_key = next(self.keys)
+            self._record(
+                INSERT,
+                (
+                    request.journal_key,
+                    request.id,
+                    request.start,
+                    Status.QUEUED,
+                    pickle.dumps(request, pickle.HIGHEST_PROTOCOL),
+                ),
+            )
+        else:
+            self._record(UPDATE, (Status.QUEUED, key))
+
+    def notify_start_of_request(self, request):
+        self._record(UPDATE, (Status.ACTIVE, request.journal_key))
+
+    def notify_end_of_request(self, request):
+        # Requests canceled before they were first queued were never recorded
+        key = getattr(request, "journal_key", None)
+        if key is not None:
+            self._record(DELETE, (key,))
+
+    def _write(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+
+            with self.db:
+                for sql, params in batch:
+                    self.db.execute(sql, params)
+
+            with self.condition:
+                self.written += len(batch)
+                self.condition.notify_all()
+
+    def flush(self):
+        """Wait until all the events recorded so far are written to disk"""
+        with self.condition:
+            target = self.recorded
+            while self.written < target:
+                self.condition.wait()
+
+    def close(self):
+        """Write the remaining events and close the database"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.db.close()
@@ -0,0 +1,282 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import bisect
+import collections
+import threading
+import time
+
+from queueos.qos.Rule import Context
+
+# Upper bounds of the buckets of the histograms, in seconds
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10)
+WAIT_BUCKETS = (0.1, 1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+# Label used for the users beyond 'max_users'
+OTHER_USERS = "<other>"
+
+
+class Histogram:
+    """A Prometheus histogram. It is not thread-safe: each histogram is only
+    observed with a given lock held, e.g. the condition of the Dispatcher."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class TimedLock:
+    """A re-entrant lock that records how long threads wait for it and how long
+    they hold it. Only the outermost acquisition is timed. It can be given to
+    a threading.Condition, in which case the time spent in wait() does not
+    count as held."""
+
+    def __init__(self, wait, hold):
+        self.lock = threading.RLock()
+        self.wait = wait
+        self.hold = hold
+        # Only changed by the thread holding the lock
+        self.depth = 0
+        self.since = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.depth and self.lock._is_owned():
+            # Re-entrant acquisitions are not timed
+            self.lock.acquire()
+            self.depth += 1
+            return True
+        start = time.perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.since = time.perf_counter()
+        self.wait.observe(self.since - start)
+        self.depth = 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.hold.observe(time.perf_counter() - self.since)
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    # Used by threading.Condition
+    def _is_owned(self):
+        return self.lock._is_owned()
+
+    def _release_save(self):
+        self.hold.observe(time.perf_counter() - self.since)
+        depth, self.depth = self.depth, 0
+        return (self.lock._release_save(), depth)
+
+    def _acquire_restore(self, state):
+        saved, depth = state
+        self.lock._acquire_restore(saved)
+        self.depth = depth
+        self.since = time.perf_counter()
+
+
+class Metrics:
+    """This class records metrics about a Broker and exposes them in the
+    Prometheus text format, see expose(). It is registered as a listener of
+    the Dispatcher to measure how long requests wait in the queue, per user
+    and per limit. To bound the number of series, users beyond the first
+    'max_users' are reported together.
+
+    Recording is done with the lock of the measured object held and costs a
+    few calls to time.perf_counter(). The gauges are computed when the metrics
+    are exposed, without going through the requests more than once.
+    """
+
+    def __init__(self, max_users=1000, prefix="queueos"):
+        self.max_users = max_users
+        self.prefix = prefix
+        self.histograms = {}
+        self.user_waits = {}
+        self.limit_waits = {}
+        self.dispatcher = None
+        self.qos = None
+
+        # Time at which the known requests were (last) queued
+        self.enqueued = {}
+
+        self.pick = self.histogram("pick_seconds", LATENCY_BUCKETS)
+
+    def histogram(self, name, buckets, **labels):
+        """Returns the histogram 'name' with the given labels, creating it if
+        needed"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def timed_lock(self, name):
+        """Returns a TimedLock whose times are recorded with the label lock='name'"""
+        return TimedLock(
+            self.histogram("lock_wait_seconds", LATENCY_BUCKETS, lock=name),
+            self.histogram("lock_hold_seconds", LATENCY_BUCKETS, lock=name),
+        )
+
+    def attach(self, dispatcher, qos):
+        """Start recording the requests of 'dispatcher', scheduled by 'qos'"""
+        self.dispatcher = dispatcher
+        self.qos = qos
+        dispatcher.add_listener(self)
+
+    def notify_enqueue_of_request(self, request):
+        self.enqueued[request] = time.time()
+
+    def notify_start_of_request(self, request):
+        queued = self.enqueued.pop(request, None)
+        if queued is None:
+            return
+        wait = time.time() - queued
+
+        self._user_wait(request).observe(wait)
+        for limit in self.qos.limits_for(request):
+            self._limit_wait(limit).observe(wait)
+
+    def notify_end_of_request(self, request):
+        self.enqueued.pop(request, None)
+
+    def _user_wait(self, request):
+        user = str(getattr(request, "user", None))
+        histogram = self.user_waits.get(user)
+        if histogram is None:
+            if len(self.user_waits) >= self.max_users:
+                user = OTHER_USERS
+            histogram = self.histogram("user_wait_seconds", WAIT_BUCKETS, user=user)
+            if user != OTHER_USERS:
+                self.user_waits[user] = histogram
+        return histogram
+
+    def _limit_wait(self, limit):
+        # The per-user limits cloned from the same rule share their 'info'
+        histogram = self.limit_waits.get(limit.info)
+        if histogram is None:
+            histogram = self.histogram(
+                "limit_wait_seconds", WAIT_BUCKETS, limit=rule_name(limit)
+            )
+            self.limit_waits[limit.info] = histogram
+        return histogram
+
+    def expose(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+
+        def gauge(name, help, values):
+            name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        if self.dispatcher is not None:
+            with self.dispatcher.condition:
+                statuses = collections.Counter(
+                    r.status for r in self.dispatcher.known_requests
+                )
+                workers = self.dispatcher.number_of_workers
+                autoscaler = self.dispatcher.autoscaler
+                scaling = {} if autoscaler is None else autoscaler.metrics()
+
+            gauge(
+                "requests",
+                "Number of requests known to the broker, per status",
+                [((("status", s),), n) for s, n in sorted(statuses.items())],
+            )
+            gauge("workers", "Number of workers", [((), workers)])
+            for key, value in scaling.items():
+                gauge(f"autoscaler_{key}", "Autoscaler decision", [((), value)])
+
+        if self.qos is not None:
+            with self.qos.lock:
+                caches = self.qos.metrics()
+                limits = [
+                    ((("limit", rule_name(limit)),), limit)
+                    for limit in self.qos.rules.global_limits
+                    if limit.per is None
+                ]
+                limits += [
+                    ((("limit", rule_name(limit)), ("key", str(key))), limit)
+                    for limit, (_, key) in self.qos.keyed_limits.items()
+                ]
+                limits += [
+                    ((("limit", rule_name(limit)), ("user", user)), limit)
+                    for user, limit in self.qos.per_user_limits.items()
+                ]
+                values = [(labels, limit.value) for labels, limit in limits]
+                utilization = [
+                    (labels, limit.value / limit.last_capacity)
+                    for labels, limit in limits
+                    if limit.last_capacity
+                ]
+
+            gauge(
+                "qos_cache_size",
+                "Number of entries in the caches of the QoS",
+                [((("cache", k),), v) for k, v in caches.items()],
+            )
+            gauge("limit_value", "Number of requests holding a limit", values)
+            gauge(
+                "limit_utilization",
+                "Value of a limit divided by its last computed capacity",
+                utilization,
+            )
+
+        # Histograms are grouped by name
+        by_name = collections.defaultdict(list)
+        for (name, labels), histogram in list(self.histograms.items()):
+            by_name[name].append((labels, histogram))
+
+        for name, series in sorted(by_name.items()):
+            name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                # Copy the values, as they may be changed by other threads
+                counts = list(histogram.counts)
+                total, count = histogram.sum, histogram.count
+                cumulative = 0
+                for bound, n in zip(histogram.buckets + ("+Inf",), counts):
+                    cumulative += n
+                    le = labels + (("le", str(bound)),)
+                    lines.append(f"{name}_bucket{format_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def rule_name(rule):
+    return rule.info.evaluate(Context(None, rule.environment))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    text = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+    return "{" + text + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
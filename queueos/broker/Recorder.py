@@ -0,0 +1,77 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import csv
+import threading
+import time
+
+
+class Recorder:
+    """This class captures the workload of a Broker in a CSV file, with one
+    line per request written when the request ends. When the Recorder is
+    closed, the lines are sorted by arrival. The columns are the time
+    at which the request was first queued, the duration of its last
+    execution, its user, its outcome (COMPLETE or ABORTED) and the request
+    attributes listed in 'attributes', such as 'dataset'.
+
+    The file can be given as is to the Simulator, to see how other rules
+    would schedule the workload, or to the Replayer, to run it again
+    through a live Broker. The Recorder is registered as a listener of the
+    Dispatcher by the Broker.
+    """
+
+    def __init__(self, path, attributes=()):
+        self.attributes = tuple(attributes)
+        self.lock = threading.Lock()
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(
+            ("arrival", "duration", "user", "outcome") + self.attributes
+        )
+        # Time at which the requests were first queued and last started
+        self.arrivals = {}
+        self.starts = {}
+
+    def notify_enqueue_of_request(self, request):
+        # Retried requests are queued again, only the first time counts
+        self.arrivals.setdefault(request, time.time())
+
+    def notify_start_of_request(self, request):
+        self.starts[request] = time.time()
+
+    def notify_end_of_request(self, request):
+        now = time.time()
+        arrival = self.arrivals.pop(request, now)
+        start = self.starts.pop(request, now)
+        row = (
+            f"{arrival:.6f}",
+            f"{now - start:.6f}",
+            getattr(request, "user", ""),
+            request.status,
+        ) + tuple(getattr(request, a, "") for a in self.attributes)
+        with self.lock:
+            self.writer.writerow(row)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+            with open(self.file.name, newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                rows = sorted(reader, key=lambda row: float(row[0]))
+
+            with open(self.file.name, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(rows)
@@ -0,0 +1,111 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import argparse
+import time
+
+from queueos.broker.Broker import Broker
+from queueos.broker.Environment import Environment
+from queueos.broker.Request import Status
+from queueos.dispatcher.Simulator import SimulatedRequest, read_workload
+
+
+class ReplayFailure(Exception):
+    """Raised by the replayed requests that were aborted when recorded"""
+
+
+class ReplayedRequest(SimulatedRequest):
+    """A request read from a workload, whose execution takes the recorded
+    duration divided by 'speed'. With the 'sleep' work, the worker sleeps,
+    with 'spin' it keeps the CPU busy, and with None it returns at once."""
+
+    work = "sleep"
+    speed = 1.0
+    outcome = Status.COMPLETE
+
+    def execute(self):
+        duration = self.duration / self.speed
+        if self.work == "sleep":
+            time.sleep(duration)
+        elif self.work == "spin":
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                pass
+        if self.outcome != Status.COMPLETE:
+            raise ReplayFailure(f"Recorded as {self.outcome}")
+
+
+class Replayer:
+    """This class feeds a workload recorded by a Recorder into a live Broker.
+    The requests are queued at their recorded arrival times, divided by
+    'speed', so that 10 replays ten times faster. If 'speed' is None, all
+    the requests are queued at once, to measure the maximum throughput of
+    the dispatcher and the QoS. The start times of the requests are those
+    of the replay, not the recorded ones.
+
+    The workload is read when the Replayer is created, which registers the
+    functions of its columns, so it must be created before the rules of the
+    Broker are parsed.
+    """
+
+    def __init__(self, path, speed=1.0, work="sleep"):
+        self.speed = speed
+        self.requests = sorted(
+            read_workload(path, ReplayedRequest), key=lambda r: r.start
+        )
+        for request in self.requests:
+            request.speed = speed or 1.0
+            request.work = work
+
+    def replay(self, broker):
+        """Queue the requests in 'broker' and wait until they are all done.
+        Returns the number of requests and the time it took."""
+        requests = self.requests
+        start = time.time()
+
+        if self.speed is None:
+            now = time.time()
+            for request in requests:
+                request.start = now
+            broker.enqueue_many(requests)
+        elif requests:
+            first = requests[0].start
+            for request in requests:
+                delay = (request.start - first) / self.speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                request.start = time.time()
+                broker.enqueue(request)
+
+        broker.wait_for_all_requests()
+        return len(requests), time.time() - start
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded workload")
+    parser.add_argument("rules", help="the rules file")
+    parser.add_argument("workload", help="a CSV file written by a Recorder")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--speed", type=float, help="default: as fast as possible")
+    parser.add_argument("--work", choices=["sleep", "spin", "none"], default="sleep")
+    args = parser.parse_args(args)
+
+    replayer = Replayer(
+        args.workload,
+        args.speed,
+        None if args.work == "none" else args.work,
+    )
+    broker = Broker(args.rules, args.workers, Environment())
+    count, elapsed = replayer.replay(broker)
+    broker.shutdown()
+    print(f"{count} requests in {elapsed:.3f}s, {count / elapsed:.1f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
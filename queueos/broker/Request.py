@@ -9,6 +9,7 @@
 
 import threading
 import time
+from concurrent.futures import Future, InvalidStateError
 
 ID = 0
 LOCK = threading.RLock()
@@ -17,6 +18,7 @@ LOCK = threading.RLock()
 class Status:
 
     UNKNOWN = "UNKNOWN"
+    DELAYED = "DELAYED"
     QUEUED = "QUEUED"
     SUBMITTED = "SUBMITTED"
     ACTIVE = "ACTIVE"
@@ -24,15 +26,50 @@ class Status:
     COMPLETE = "COMPLETE"
 
 
+def reserve_ids(last):
+    """Make sure that new requests get an id greater than 'last', e.g. when
+    requests are reloaded from a journal."""
+    global ID
+    with LOCK:
+        ID = max(ID, last + 1)
+
+
+class RequestCanceled(Exception):
+    """Exception set on the future of a request that was denied execution
+    or canceled before it started."""
+
+
 class Request:
 
     """
-    * TODO: The self.startTime must be established when the request is added to the
-    * Broker queue. The self.startTime must be persistent, i.e. it must be stored
-    * in a database so that when we restart the Broker and re-populate its
-    * queue, the original start time is preserved.
+    The start time of a request is established when it is created. To preserve
+    it across restarts of the Broker, give the Broker a Journal: requests are
+    then pickled when queued and reloaded with their original start time.
+
+    The future of a request is only created when it is first asked for, as
+    it is much larger than the request itself. The outcome of the request is
+    kept so that a future created after the request finished is resolved.
     """
 
+    __slots__ = (
+        "id",
+        "canceled",
+        "error",
+        "status",
+        "start",
+        "dispatcher",
+        "retry_policy",
+        "attempts",
+        "journal_key",
+        "_future",
+        "_outcome",
+        "__weakref__",
+    )
+
+    # The function returning the current time, used for the start time and
+    # the age of requests. It can be replaced, e.g. for tests or simulations.
+    clock = staticmethod(time.time)
+
     def __init__(self):
         with LOCK:
             global ID
@@ -43,12 +80,88 @@ class Request:
         self.error = None
         self.status = Status.UNKNOWN
 
-        self.start = time.time()
+        self.start = self.clock()
         self.dispatcher = None
 
+        # Set to a RetryPolicy to override the one given by the rules
+        self.retry_policy = None
+        self.attempts = 0
+
+        self.journal_key = None
+
+        # Resolved with the result of execute(), or the error
+        self._future = None
+        self._outcome = None
+
     def execute(self):
         raise NotImplementedError("Please override this method")
 
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in STATE}
+        state.update(getattr(self, "__dict__", {}))
+        return state
+
+    def __setstate__(self, state):
+        # The dispatcher and the future only make sense in the current process
+        self.dispatcher = None
+        self._future = None
+        self._outcome = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def future(self):
+        """A concurrent.futures.Future resolved with the result of execute(), or
+        the error."""
+        with LOCK:
+            if self._future is not None:
+                return self._future
+            future = self._future = Future()
+            outcome = self._outcome
+            if self.status == Status.ACTIVE:
+                future.set_running_or_notify_cancel()
+        future.add_done_callback(self._future_done)
+        if outcome is not None:
+            resolve(future, outcome)
+        return future
+
+    def _future_done(self, future):
+        if future.cancelled() and self.dispatcher is not None:
+            self.dispatcher.canceled(self)
+
+    def set_running(self):
+        """Called when the request starts. Returns False if the client canceled
+        its future."""
+        with LOCK:
+            future = self._future
+        if future is None or future.running():
+            return True
+        return future.set_running_or_notify_cancel()
+
+    def set_result(self, result):
+        self._set_outcome((result, None))
+
+    def set_exception(self, error):
+        if not isinstance(error, BaseException):
+            error = RequestCanceled(error)
+        self._set_outcome((None, error))
+
+    def _set_outcome(self, outcome):
+        with LOCK:
+            self._outcome = outcome
+            future = self._future
+        if future is not None:
+            resolve(future, outcome)
+
+    def result(self, timeout=None):
+        """Wait for the request to finish and return the result of execute(), or
+        raise its error."""
+        return self.future.result(timeout)
+
+    def add_done_callback(self, callback):
+        """Call 'callback' with the request as argument when it has finished."""
+        self.future.add_done_callback(lambda future: callback(self))
+
     @property
     def age(self):
         """Returns the age of the request in seconds".
@@ -56,4 +169,24 @@ class Request:
         Returns:
             float: Age in seconds.
         """
-        return time.time() - self.start
+        return self.clock() - self.start
+
+    def age_at(self, now):
+        """Returns the age of the request in seconds at time 'now'"""
+        return now - self.start
+
+
+# The attributes saved when a request is pickled
+STATE = ("id", "canceled", "error", "status", "start", "retry_policy", "attempts")
+
+
+def resolve(future, outcome):
+    result, error = outcome
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        # Canceled by the client, or already resolved
+        pass
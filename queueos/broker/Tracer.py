@@ -0,0 +1,228 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import argparse
+import collections
+import json
+import struct
+import threading
+import time
+
+from queueos.broker.Metrics import rule_name
+from queueos.broker.Request import Status
+
+MAGIC = b"QOST"
+VERSION = 1
+
+# time, event, request id, argument
+RECORD = struct.Struct("<dBqq")
+
+ENQUEUE = 1
+PICK = 2
+BLOCKED = 3
+START = 4
+END = 5
+ENVIRONMENT = 6
+
+EVENTS = {
+    ENQUEUE: "enqueue",
+    PICK: "pick",
+    BLOCKED: "blocked",
+    START: "start",
+    END: "end",
+    ENVIRONMENT: "environment",
+}
+
+
+class Tracer:
+    """This class records the scheduling decisions of a Broker in a ring
+    buffer of fixed size records, so that the cost of tracing is bounded
+    and only the last 'capacity' events are kept. The events are:
+
+    - enqueue: a request enters the queue
+    - pick: a request is selected, the argument is the length of the queue
+    - blocked: a queued request cannot run because of a full limit, the
+      argument is the name of the limit; only recorded when it changes
+    - start and end: the argument of 'end' is 1 if the request completed
+    - environment: the environment changed
+
+    Call dump() to write the buffer to a file, and use
+    'python -m queueos.broker.Tracer' to analyse it. When no tracer is
+    attached, the Dispatcher and the QoS only test that their 'tracer'
+    attribute is None.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.lock = threading.Lock()
+        self.count = 0
+        # The names of the limits, recorded by index
+        self.indexes = {}
+        self.names = []
+        # Last limit recorded as blocking each queued request
+        self.blocking = {}
+
+    def attach(self, dispatcher, qos, environment):
+        """Start tracing the decisions of 'dispatcher' and 'qos'"""
+        dispatcher.tracer = self
+        qos.tracer = self
+        dispatcher.add_listener(self)
+        environment.add_observer(self)
+
+    def _record(self, event, request_id, argument=0):
+        with self.lock:
+            offset = (self.count % self.capacity) * RECORD.size
+            RECORD.pack_into(
+                self.buffer, offset, time.time(), event, request_id, argument
+            )
+            self.count += 1
+
+    def _name(self, limit):
+        with self.lock:
+            index = self.indexes.get(limit.info)
+            if index is None:
+                index = len(self.names)
+                self.indexes[limit.info] = index
+                self.names.append(rule_name(limit))
+            return index
+
+    def picked(self, request, queue_length):
+        self._record(PICK, request.id, queue_length)
+
+    def blocked(self, request, limit):
+        if self.blocking.get(request.id) is not limit.info:
+            self.blocking[request.id] = limit.info
+            self._record(BLOCKED, request.id, self._name(limit))
+
+    def notify_enqueue_of_request(self, request):
+        self._record(ENQUEUE, request.id)
+
+    def notify_start_of_request(self, request):
+        self.blocking.pop(request.id, None)
+        self._record(START, request.id)
+
+    def notify_end_of_request(self, request):
+        self.blocking.pop(request.id, None)
+        self._record(END, request.id, request.status == Status.COMPLETE)
+
+    def notify_environment_changed(self):
+        self._record(ENVIRONMENT, -1)
+
+    def records(self):
+        """Returns the events in the buffer, oldest first, as tuples of
+        (time, event, request id, argument)"""
+        with self.lock:
+            count = self.count
+            data = bytes(self.buffer)
+        first = max(0, count - self.capacity)
+        return [
+            RECORD.unpack_from(data, (i % self.capacity) * RECORD.size)
+            for i in range(first, count)
+        ]
+
+    def dump(self, path):
+        """Write the events in the buffer to 'path'"""
+        records = self.records()
+        with self.lock:
+            header = json.dumps(self.names).encode()
+
+        with open(path, "wb") as f:
+            f.write(struct.pack("<4sHII", MAGIC, VERSION, len(header), len(records)))
+            f.write(header)
+            for record in records:
+                f.write(RECORD.pack(*record))
+
+
+def load(path):
+    """Returns the names of the limits and the events of a trace written by
+    Tracer.dump()"""
+    with open(path, "rb") as f:
+        magic, version, size, count = struct.unpack("<4sHII", f.read(14))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a trace file")
+        names = json.loads(f.read(size))
+        data = f.read(count * RECORD.size)
+    return names, list(RECORD.iter_unpack(data))
+
+
+def summary(names, records, out=print):
+    if not records:
+        out("No events")
+        return
+
+    counts = collections.Counter(event for _, event, _, _ in records)
+    out(f"{len(records)} events over {records[-1][0] - records[0][0]:.3f}s")
+    for event, name in EVENTS.items():
+        out(f"    {name:12} {counts[event]}")
+
+    blocked = collections.Counter(
+        names[arg] for _, e, _, arg in records if e == BLOCKED
+    )
+    if blocked:
+        out("Limits blocking requests:")
+        for name, count in blocked.most_common():
+            out(f"    {count:8} {name}")
+
+    enqueued = {}
+    waits = []
+    for when, event, request, _ in records:
+        if event == ENQUEUE:
+            enqueued[request] = when
+        elif event == START and request in enqueued:
+            waits.append((when - enqueued.pop(request), request))
+    if waits:
+        waits.sort(reverse=True)
+        out(f"Wait: mean {sum(w for w, _ in waits) / len(waits):.3f}s")
+        out("Longest waits:")
+        for wait, request in waits[:10]:
+            out(f"    request {request}: {wait:.3f}s")
+
+
+def explain(names, records, request_id, out=print):
+    """Print why a request waited: the limits that blocked it and the requests
+    picked before it"""
+    enqueued = None
+    for when, event, request, arg in records:
+        if request == request_id:
+            if event == ENQUEUE:
+                enqueued = when
+                out(f"{when:.6f} enqueued")
+            elif event == BLOCKED:
+                out(f"{when:.6f} blocked by limit {names[arg]}")
+            elif event == START:
+                if enqueued is not None:
+                    out(f"{when:.6f} started after waiting {when - enqueued:.3f}s")
+                else:
+                    out(f"{when:.6f} started")
+                enqueued = None
+            elif event == END:
+                out(f"{when:.6f} {'completed' if arg else 'aborted'}")
+        elif enqueued is not None:
+            if event == PICK:
+                out(f"{when:.6f} overtaken by request {request}")
+            elif event == ENVIRONMENT:
+                out(f"{when:.6f} environment changed")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Analyse a queueos trace")
+    parser.add_argument("path", help="a file written by Tracer.dump()")
+    parser.add_argument("--request", type=int, help="explain why a request waited")
+    args = parser.parse_args(args)
+
+    names, records = load(args.path)
+    if args.request is None:
+        summary(names, records)
+    else:
+        explain(names, records, args.request)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import collections
+
+# What to do with a request that does not fit in the queue
+BLOCK = "block"
+RAISE = "raise"
+SHED = "shed"
+
+POLICIES = (BLOCK, RAISE, SHED)
+
+
+class QueueFull(Exception):
+    """Raised by enqueue() when a request does not fit in the queue, and set
+    on the future of the requests that were shed."""
+
+
+class Admission:
+    """This class bounds the number of requests waiting in the queue of a
+    Dispatcher. The bounds are 'max_queued' for all the requests,
+    'max_queued_per_user' for the requests of each user, and the 'queue'
+    rules of the picker, whose conclusion is the maximum number of waiting
+    requests matching their condition.
+
+    When a request does not fit, the 'policy' decides:
+
+    - block: the caller waits until a request starts, at most 'timeout'
+      seconds, after which QueueFull is raised
+    - raise: QueueFull is raised at once
+    - shed: the request with the lowest priority among the ones sharing
+      the full bound is aborted with QueueFull, which may be the new one
+
+    A request counts from the moment it is admitted until it starts or is
+    aborted. Retried requests were already admitted, and requests given to
+    enqueue_at() are scheduled by the broker itself, so neither is counted.
+    The Admission is registered as a listener of the Dispatcher, so its
+    methods are called with the condition held.
+    """
+
+    def __init__(
+        self,
+        max_queued=None,
+        max_queued_per_user=None,
+        policy=RAISE,
+        timeout=None,
+    ):
+        assert policy in POLICIES, policy
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.policy = policy
+        self.timeout = timeout
+        # The bounds of each waiting request, and the requests of each bound
+        self.waiting = {}
+        self.members = collections.defaultdict(set)
+
+    def bounds(self, request, picker):
+        """Returns the bounds of 'request', as a list of (key, capacity)"""
+        bounds = []
+        if self.max_queued is not None:
+            bounds.append(("queue", self.max_queued))
+        if self.max_queued_per_user is not None:
+            user = getattr(request, "user", None)
+            bounds.append((("user", user), self.max_queued_per_user))
+        if hasattr(picker, "queue_limits_for"):
+            for rule in picker.queue_limits_for(request):
+                bounds.append((rule, rule.evaluate(request)))
+        return bounds
+
+    def full(self, bounds):
+        """Returns the key of the first full bound, or None"""
+        for key, capacity in bounds:
+            if len(self.members.get(key, ())) >= capacity:
+                return key
+        return None
+
+    def add(self, request, bounds):
+        keys = [key for key, _ in bounds]
+        self.waiting[request] = keys
+        for key in keys:
+            self.members[key].add(request)
+
+    def remove(self, request):
+        for key in self.waiting.pop(request, ()):
+            members = self.members[key]
+            members.discard(request)
+            if not members:
+                del self.members[key]
+
+    def notify_enqueue_of_request(self, request):
+        pass
+
+    def notify_start_of_request(self, request):
+        self.remove(request)
+
+    def notify_end_of_request(self, request):
+        self.remove(request)
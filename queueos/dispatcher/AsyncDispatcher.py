@@ -0,0 +1,168 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import asyncio
+import inspect
+import threading
+import time
+
+from queueos.dispatcher.Dispatcher import NOTHING, Dispatcher, min_timeout
+
+
+class LoopCondition(threading.Condition):
+    """A condition that also wakes up the event loop of an AsyncDispatcher, so
+    that the bookkeeping inherited from the Dispatcher can be shared unchanged."""
+
+    def __init__(self, wakeup, lock=None):
+        super().__init__(lock)
+        self.wakeup = wakeup
+
+    def notify_all(self):
+        super().notify_all()
+        self.wakeup()
+
+
+class AsyncDispatcher(Dispatcher):
+    """A Dispatcher that runs requests as tasks of an asyncio event loop instead
+    of worker threads. Requests whose 'execute' method is a coroutine function
+    are awaited on the loop, so thousands of them can be in flight at the same
+    time. Other requests are run in the default executor of the loop.
+
+    The picker and observer are used exactly as with the threaded Dispatcher.
+    The maximum number of requests running concurrently plays the role of the
+    number of workers, including in rules using 'numberOfWorkers'.
+    """
+
+    def __init__(
+        self,
+        max_concurrency,
+        picker,
+        observer,
+        environment,
+        queue=None,
+        metrics=None,
+        admission=None,
+    ):
+        self.loop = None
+        self.event = None
+        self.task = None
+        self.stopped = False
+        self.tasks = set()
+        self.waiters = []
+        super().__init__(
+            max_concurrency,
+            picker,
+            observer,
+            environment,
+            queue=queue,
+            metrics=metrics,
+            admission=admission,
+        )
+
+    def create_condition(self, lock):
+        return LoopCondition(self._wakeup, lock)
+
+    def _resize(self, number_of_workers):
+        """Change the maximum number of requests running concurrently. Running
+        requests are not interrupted if that number is decreased."""
+        with self.condition:
+            self.number_of_workers = number_of_workers
+            self.condition.notify_all()
+
+    def start(self):
+        """Start scheduling requests. Must be called from a coroutine running on
+        the event loop that will execute the requests."""
+        assert self.task is None
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+        return self.task
+
+    async def run(self):
+        while not self.stopped:
+            self.event.clear()
+            with self.condition:
+                self._run_timers()
+                deadline = None
+                while not self.paused and len(self.tasks) < self.number_of_workers:
+                    request = self._select()
+                    if request is NOTHING:
+                        deadline = self.picker.next_wakeup(self.queue)
+                        break
+                    if request is not None:
+                        self._start(request)
+                now = time.time()
+                timeout = self.timers.timeout(now)
+                if deadline is not None:
+                    timeout = min_timeout(timeout, max(0, deadline - now))
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, request):
+        self.started(request)
+
+        if request.canceled:
+            self.failed(request, request.canceled)
+            return
+
+        task = self.loop.create_task(self._execute(request))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def _execute(self, request):
+        try:
+            if inspect.iscoroutinefunction(request.execute):
+                result = await request.execute()
+            else:
+                result = await self.loop.run_in_executor(None, request.execute)
+            self.complete(request, result)
+        except asyncio.CancelledError as e:
+            # Release the limits of the request before the task dies
+            self.failed(request, e)
+            raise
+        except Exception as e:
+            print("!!! FAILED request:", e)
+            self.failed(request, e)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self._wakeup()
+
+    def _wakeup(self):
+        # Can be called from any thread, e.g. by the environment
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._woken)
+
+    def _woken(self):
+        self.event.set()
+        with self.condition:
+            if len(self.known_requests) > 0:
+                return
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_for_all_requests(self):
+        """Wait for the active and queued requests to complete."""
+        with self.condition:
+            if len(self.known_requests) == 0:
+                return
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+        await waiter
+
+    async def shutdown(self):
+        """Wait for all requests to complete and stop scheduling"""
+        await self.wait_for_all_requests()
+        self.stopped = True
+        self.event.set()
+        await self.task
@@ -0,0 +1,125 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import collections
+
+from queueos.broker.Request import Status
+
+
+class Autoscaler:
+    """This class is a policy that lets a Dispatcher change its number of
+    workers according to the load. Workers are added when queued requests
+    that can run (i.e. that are not blocked by a full limit) outnumber the
+    idle workers, and a worker is retired when it has been idle for
+    'idle_timeout' seconds. The number of workers is kept between
+    'min_workers' and 'max_workers'.
+
+    Checking whether a request can run is costly, so the requests found
+    runnable are remembered. When requests are enqueued, the queued ones
+    cannot have become runnable, as no limit was freed, so only the new
+    ones are checked. The whole queue is scanned again after other events,
+    such as the end of a request.
+
+    The methods of this class are called by the Dispatcher with its condition
+    held.
+    """
+
+    def __init__(self, min_workers=0, max_workers=10, idle_timeout=60):
+        assert 0 <= min_workers <= max_workers
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+
+        # Decisions, exported by metrics()
+        self.workers = 0
+        self.runnable = 0
+        self.scale_ups = 0
+        self.scale_downs = 0
+        self.blocked = 0
+
+        # The queued requests found runnable by the last scan, used as an
+        # ordered set, and the ones it has not checked yet. The scan is
+        # started again when 'unchecked' is None.
+        self.candidates = {}
+        self.unchecked = None
+
+    def minimum(self, dispatcher):
+        """Returns the minimum number of workers. At least one worker is kept
+        while timers are pending, so they are run."""
+        return max(self.min_workers, 1 if len(dispatcher.timers) else 0)
+
+    def workers_to_add(self, dispatcher, requests=None):
+        """Returns the number of workers that the dispatcher should start.
+        'requests' are the requests just enqueued, if that is the event that
+        triggered the call."""
+        self.workers = dispatcher.number_of_workers
+
+        missing = self.minimum(dispatcher) - dispatcher.number_of_workers
+        room = self.max_workers - dispatcher.number_of_workers
+        if room <= 0:
+            self.unchecked = None
+            return max(0, missing)
+
+        # Count the requests that could be started now, but stop counting
+        # when there are enough of them to fill the pool
+        # Workers that will pick a stop marker are not available
+        idle = dispatcher.number_of_idle_workers - dispatcher.queue.count(None)
+        can_run = dispatcher.picker.can_run
+
+        if requests is None or self.unchecked is None:
+            self.candidates = {}
+            self.unchecked = collections.deque(dispatcher.queue)
+        else:
+            # The candidates may have started, or be blocked by the ones that did
+            self.candidates = {
+                request: None
+                for request in self.candidates
+                if request.status == Status.QUEUED and can_run(request)
+            }
+            self.unchecked.extend(requests)
+
+        unchecked = self.unchecked
+        while unchecked and len(self.candidates) < idle + room:
+            request = unchecked.popleft()
+            if request is None or request.status != Status.QUEUED:
+                continue
+            if can_run(request):
+                self.candidates[request] = None
+
+        runnable = len(self.candidates)
+        self.runnable = runnable
+        if runnable == 0 and len(dispatcher.queue) > dispatcher.queue.count(None):
+            # Adding workers would not help, all the requests are waiting
+            # for a limit to free up
+            self.blocked += 1
+
+        count = max(missing, min(room, runnable - idle))
+        if count > 0:
+            self.scale_ups += count
+            self.workers += count
+        return max(0, count)
+
+    def retire(self, dispatcher):
+        """Called on behalf of a worker that has been idle for 'idle_timeout'
+        seconds. Returns True if that worker should stop."""
+        if dispatcher.number_of_workers <= self.minimum(dispatcher):
+            return False
+        self.scale_downs += 1
+        self.workers = dispatcher.number_of_workers - 1
+        return True
+
+    def metrics(self):
+        """Returns the decisions of the autoscaler as a dictionary."""
+        return dict(
+            workers=self.workers,
+            runnable=self.runnable,
+            scale_ups=self.scale_ups,
+            scale_downs=self.scale_downs,
+            blocked=self.blocked,
+        )
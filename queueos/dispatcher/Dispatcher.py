@@ -8,8 +8,24 @@
 #
 
 import threading
+import time
 
-from queueos.broker.Request import Status
+from queueos.broker.Request import RequestCanceled, Status
+from queueos.dispatcher.Admission import BLOCK, SHED, QueueFull
+from queueos.dispatcher.ShardedQueue import ShardedQueue
+from queueos.dispatcher.Timers import Timers
+
+# Returned by Dispatcher._select() when no request can be run
+NOTHING = object()
+
+
+def min_timeout(a, b):
+    """Returns the shortest of two timeouts, where None means no timeout"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
 
 
 class Worker:
@@ -19,26 +35,35 @@ class Worker:
     def __call__(self):
 
         while True:
+            # The request is already started
             request = self.dispatcher.next_request()
             if request is None:
                 break
 
-            self.dispatcher.started(request)
-
             if request.canceled:
                 self.dispatcher.failed(request, request.canceled)
                 continue
 
             try:
-                request.execute()
-                self.dispatcher.complete(request)
+                result = request.execute()
+                self.dispatcher.complete(request, result)
             except Exception as e:
                 print("!!! FAILED request:", e)
                 self.dispatcher.failed(request, e)
 
 
 class Dispatcher:
-    def __init__(self, number_of_workers, picker, observer, environment):
+    def __init__(
+        self,
+        number_of_workers,
+        picker,
+        observer,
+        environment,
+        autoscaler=None,
+        queue=None,
+        metrics=None,
+        admission=None,
+    ):
         """
 
         Args:
@@ -46,31 +71,57 @@ class Dispatcher:
             picker ([type]): the object that is responsible for selecting the next request to be run
             observer ([type]):an object that in notified on certain events such as the starting and ending of requests
             environment ([type]):
+            autoscaler ([type]): optional policy that changes the number of workers according to the load
+            queue ([type]): optional queue, such as a ShardedQueue. By default, a list
+            metrics ([type]): optional Metrics recording the pick latency and the lock times
+            admission ([type]): optional Admission bounding the number of waiting requests
         """
         self.picker = picker
         self.observer = observer
-        self.queue = []
-        self.condition = threading.Condition()
+        self.autoscaler = autoscaler
+        self.queue = queue if queue is not None else []
+        self.timers = Timers()
+        self.metrics = metrics
+        # Optional Tracer, see Tracer.attach()
+        self.tracer = None
+        self.condition = self.create_condition(
+            None if metrics is None else metrics.timed_lock("dispatcher")
+        )
         self.number_of_workers = 0
+        self.number_of_idle_workers = 0
         self.known_requests = []
+        self.listeners = []
         self.number_of_active_requests = 0
         self.paused = False
 
+        self.admission = admission
+        if admission is not None:
+            self.listeners.append(admission)
+
         environment.add_observer(self)
-        self.set_number_of_workers(number_of_workers)
+        self._resize(number_of_workers)
+
+    def create_condition(self, lock):
+        return threading.Condition(lock)
 
     def set_number_of_workers(self, number_of_workers):
         """Change the number of workers.
 
         This method will either stop some workers or
         start ones. Any worker will finish their work before stopping, so
-        that change may take a while to take effect.
+        that change may take a while to take effect. If an autoscaler is set,
+        its bounds are both set to that number, so it does not undo the change.
         """
+        with self.condition:
+            if self.autoscaler is not None:
+                self.autoscaler.min_workers = number_of_workers
+                self.autoscaler.max_workers = number_of_workers
+            self._resize(number_of_workers)
+
+    def _resize(self, number_of_workers):
         with self.condition:
             while self.number_of_workers < number_of_workers:
-                worker = Worker(self)
-                threading.Thread(target=worker, daemon=True).start()
-                self.number_of_workers += 1
+                self._start_worker()
 
             while self.number_of_workers > number_of_workers:
                 # Enqueuing None will stop the worker that selects that request
@@ -79,82 +130,379 @@ class Dispatcher:
 
             self.condition.notify_all()
 
-    def enqueue(self, request):
+    def add_listener(self, listener):
+        """Register an object notified when a request enters the queue, starts
+        and finally ends, with the methods notify_enqueue_of_request(),
+        notify_start_of_request() and notify_end_of_request(). A request that is
+        retried enters the queue again, but only ends once. Listeners are
+        called with the condition held."""
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def _start_worker(self):
+        worker = Worker(self)
+        threading.Thread(target=worker, daemon=True).start()
+        self.number_of_workers += 1
+
+    def _autoscale(self, requests=None):
+        """Let the autoscaler start new workers if needed. 'requests' are the
+        requests just enqueued, if that is the reason of the call, see
+        Autoscaler.workers_to_add(). Must be called with the condition held."""
+        if self.autoscaler is None or self.paused:
+            return
+
+        for _ in range(self.autoscaler.workers_to_add(self, requests)):
+            self._start_worker()
+
+    def enqueue(self, request, policy=None):
         """Add a request to the Dispatcher queue. If the request is 'None', this
         means stop the worker that will select that None.
         """
-        with self.condition:
+        if request is None:
+            with self.condition:
+                self._enqueue_locked([None])
+            return
+        self.enqueue_many([request], policy)
+
+    def enqueue_many(self, requests, policy=None):
+        """Add several requests to the Dispatcher queue at once. The picker
+        prepares them before the condition is taken, then they are all queued
+        in a single step and the workers are woken up only once. Requests
+        denied by the picker are aborted at once, without being queued.
+
+        If the Dispatcher has an Admission, the requests that do not fit in the
+        queue are handled according to 'policy', by default the one of the
+        Admission. When QueueFull is raised, the requests before the one that
+        did not fit are queued, and the others are not."""
+        requests = list(requests)
+        self._prepare(requests)
+        denied = []
+        try:
+            with self.condition:
+                requests, denied = self._admit(requests)
+                if self.admission is not None:
+                    requests = self._bound(requests, policy, denied)
+                self._queue(requests)
+        finally:
+            self._deny(denied)
+
+    def _queue(self, requests):
+        for request in requests:
+            self._register(request)
+        if requests:
+            self._enqueue_locked(requests)
+
+    def _bound(self, requests, policy, denied):
+        """Returns the requests that fit in the queue, see Admission. The requests
+        shed to make room are aborted and added to 'denied'. Must be called with
+        the condition held."""
+        admission = self.admission
+        policy = policy or admission.policy
+        deadline = None
+        if admission.timeout is not None:
+            deadline = time.time() + admission.timeout
+
+        accepted = []
+        for i, request in enumerate(requests):
+            bounds = admission.bounds(request, self.picker)
+            while True:
+                key = admission.full(bounds)
+                if key is None:
+                    admission.add(request, bounds)
+                    accepted.append(request)
+                    break
+
+                if policy == SHED:
+                    victim = self._victim(request, key)
+                    self._abort(victim, QueueFull(f"Shed from full queue: {key}"))
+                    denied.append(victim)
+                    if victim is request:
+                        break
+                    if victim in accepted:
+                        accepted.remove(victim)
+                    continue
+
+                if policy == BLOCK:
+                    # The requests accepted so far can run while we wait
+                    self._queue(accepted)
+                    accepted = []
+                    timeout = None if deadline is None else deadline - time.time()
+                    if timeout is None or timeout > 0:
+                        self.condition.wait(timeout)
+                        continue
+
+                self._queue(accepted)
+                for rejected in requests[i:]:
+                    self.observer.notify_cancel_of_request(rejected)
+                raise QueueFull(f"Queue full: {key}")
+
+        return accepted
+
+    def _victim(self, request, key):
+        """Returns the request with the lowest priority among 'request' and the
+        waiting ones sharing the bound 'key'. On a tie, 'request' is chosen."""
+        now = self.picker.clock()
+        candidates = [request]
+        candidates.extend(self.admission.members[key])
+        return min(candidates, key=lambda r: self.picker.priority(r, now))
+
+    def _admit(self, requests):
+        """Returns the prepared requests that can be queued, and the ones that
+        were denied, which are aborted. Must be called with the condition held."""
+        admitted, denied = [], []
+        for request in requests:
+            if not request.canceled:
+                admitted.append(request)
+                continue
+            self._abort(request, request.canceled)
+            denied.append(request)
+        return admitted, denied
+
+    def _abort(self, request, error):
+        """Abort a request that has not started, removing it from the queue if
+        needed. Must be called with the condition held."""
+        if request.status == Status.QUEUED:
+            self.queue.remove(request)
+        if request.status in (Status.QUEUED, Status.DELAYED):
+            self.known_requests.remove(request)
+        request.error = error
+        request.status = Status.ABORTED
+        self.observer.notify_cancel_of_request(request)
+        for listener in self.listeners:
+            listener.notify_end_of_request(request)
+
+    def _deny(self, requests):
+        # Resolved without the condition held, like in failed()
+        for request in requests:
+            request.set_exception(request.error)
+
+    def _enqueue_locked(self, requests):
+        """Add already registered requests to the queue. Must be called with
+        the condition held."""
+        for request in requests:
             if request is not None:
-                request.dispatcher = self
                 request.status = Status.QUEUED
-                self.known_requests.append(request)
-            self.queue.append(request)
+                for listener in self.listeners:
+                    listener.notify_enqueue_of_request(request)
+        self.queue.extend(requests)
+        self._autoscale(requests)
+        self.condition.notify_all()
+
+    def enqueue_at(self, request, when):
+        """Add a request to the Dispatcher queue at time 'when'. Until then, the
+        request is known to the Dispatcher but cannot be selected."""
+        self._prepare([request])
+        with self.condition:
+            admitted, denied = self._admit([request])
+            if admitted:
+                self._register(request)
+                request.status = Status.DELAYED
+                self.call_at(when, self._enqueue_delayed, request)
+        self._deny(denied)
+
+    def _enqueue_delayed(self, request):
+        # The request may have been canceled in the meantime
+        if request.status == Status.DELAYED:
+            self._enqueue_locked([request])
+
+    def _prepare(self, requests):
+        # The rules may need the dispatcher, e.g. numberOfWorkers()
+        for request in requests:
+            request.dispatcher = self
+        self.picker.prepare(requests)
+
+    def _register(self, request):
+        self.known_requests.append(request)
+
+    def call_at(self, when, callback, *args):
+        """Run 'callback' at time 'when', with the condition held. Returns a Timer
+        that can be canceled. Waiting workers are woken up when timers are due."""
+        with self.condition:
+            timer = self.timers.call_at(when, callback, *args)
+            # No request can have become runnable
+            self._autoscale(())
             self.condition.notify_all()
+            return timer
+
+    def call_later(self, delay, callback, *args):
+        """Run 'callback' in 'delay' seconds, see call_at()"""
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def _run_timers(self):
+        """Run the timers that are due. Must be called with the condition held."""
+        self.timers.run_due(time.time())
 
     def next_request(self):
         """This method is called by the worker threads to get the next request to
         execute. Returns the next request to be run, or 'None'. In this case, the worker
         thread will terminate.
         """
-        while True:
-
-            with self.condition:
-
-                while len(self.queue) == 0 or self.paused:
-                    self.condition.wait()
+        with self.condition:
+            self.number_of_idle_workers += 1
+            try:
+                idle_since = time.time()
+                while True:
+                    # Timers must run even when the queue never empties
+                    self._run_timers()
+
+                    while len(self.queue) == 0 or self.paused:
+                        if self._wait(idle_since):
+                            return None
+
+                    request = self._select()
+                    if request is None:
+                        return None
+                    if request is not NOTHING:
+                        # Start it before the condition is released, so that
+                        # another worker cannot pick a request with the same
+                        # limits before they are incremented
+                        self.started(request)
+                        return request
+
+                    # The queue is not empty, by there are no candidates selected by
+                    # the Picker, wait for some change, or until the Picker needs
+                    # to re-evaluate the queue
+                    if self._wait(idle_since, self.picker.next_wakeup(self.queue)):
+                        return None
+            finally:
+                self.number_of_idle_workers -= 1
+
+    def _wait(self, idle_since, deadline=None):
+        """Wait for some change, or until the next timer is due, or until
+        'deadline' if given. Returns True if the autoscaler decided to retire the
+        calling worker because it was idle for too long."""
+        now = time.time()
+        timeout = self.timers.timeout(now)
+        if deadline is not None:
+            timeout = min_timeout(timeout, max(0, deadline - now))
+
+        retire_at = None
+        if (
+            self.autoscaler is not None
+            and self.number_of_workers > self.autoscaler.minimum(self)
+        ):
+            retire_at = idle_since + self.autoscaler.idle_timeout
+            timeout = min_timeout(timeout, max(0, retire_at - now))
+
+        if timeout is None or timeout > 0:
+            self.condition.wait(timeout)
+
+        self._run_timers()
+
+        if retire_at is not None and time.time() >= retire_at:
+            if self.autoscaler.retire(self):
+                self.number_of_workers -= 1
+                return True
 
-                try:
-                    # This means stop the thread
-                    i = self.queue.index(None)
-                    self.queue.pop(i)
-                    self.condition.notify_all()
-                    return None
-                except ValueError:
-                    pass
+        return False
 
-                request = self.picker.pick(self.queue)
-                if request is not None:
-                    self.condition.notify_all()
-                    return request
+    def _select(self):
+        """Returns the next request to run, 'None' if the calling worker must stop,
+        or NOTHING if no request can be run at the moment. Must be called with the
+        condition held.
+        """
+        if None in self.queue:
+            # This means stop the thread
+            self.queue.remove(None)
+            self.condition.notify_all()
+            return None
+
+        start = time.perf_counter()
+        if isinstance(self.queue, ShardedQueue):
+            request = self.queue.pick(self.picker)
+        else:
+            request = self.picker.pick(self.queue)
+        if self.metrics is not None:
+            self.metrics.pick.observe(time.perf_counter() - start)
+        if request is not None:
+            if self.tracer is not None:
+                self.tracer.picked(request, len(self.queue))
+            self.condition.notify_all()
+            return request
 
-                # The queue is not empty, by there are no candidates selected by
-                # the Picker, wait for some change
-                self.condition.wait()
+        return NOTHING
 
     def started(self, request):
         """Called by a worker upon start of a request"""
         with self.condition:
+            if not request.set_running():
+                # Canceled by the client after it was picked
+                request.canceled = "Canceled"
             request.status = Status.ACTIVE
             self.observer.notify_start_of_request(request)
+            for listener in self.listeners:
+                listener.notify_start_of_request(request)
 
             self.number_of_active_requests += 1
             self.condition.notify_all()
 
     def failed(self, request, error):
-        """Called by a worker upon failure of a request"""
+        """Called by a worker upon failure of a request. If the retry policy of
+        the request allows it, the request is put back in the queue after some
+        delay instead. While it waits, it holds neither a worker nor a limit."""
         with self.condition:
             request.error = error
-            request.status = Status.ABORTED
-            self.observer.notify_end_of_request(request)
 
+            policy = None
+            if not request.canceled and isinstance(error, Exception):
+                policy = self.observer.retry_policy_for(request)
+
+            self.observer.notify_end_of_request(request)
             self.number_of_active_requests -= 1
+
+            if policy is not None and request.attempts < policy.max_retries:
+                request.attempts += 1
+                request.status = Status.DELAYED
+                self.timers.call_at(
+                    time.time() + policy.backoff(request.attempts),
+                    self._enqueue_delayed,
+                    request,
+                )
+                self._autoscale()
+                self.condition.notify_all()
+                return
+
+            request.status = Status.ABORTED
             self.known_requests.remove(request)
+            for listener in self.listeners:
+                listener.notify_end_of_request(request)
+            self._autoscale()
             self.condition.notify_all()
 
-    def complete(self, request):
+        request.set_exception(error)
+
+    def complete(self, request, result=None):
         """Called by a worker upon successful completion of a request"""
         with self.condition:
             request.status = Status.COMPLETE
             self.observer.notify_end_of_request(request)
             self.number_of_active_requests -= 1
             self.known_requests.remove(request)
+            for listener in self.listeners:
+                listener.notify_end_of_request(request)
+            self._autoscale()
+            self.condition.notify_all()
+
+        request.set_result(result)
+
+    def canceled(self, request):
+        """Called when the client cancels the future of a request. If the request
+        is still waiting, it is removed from the queue."""
+        with self.condition:
+            if request.status not in (Status.QUEUED, Status.DELAYED):
+                return
+            self._abort(request, RequestCanceled("Canceled"))
             self.condition.notify_all()
 
     def wait_for_all_requests(self):
         """Wait for the active and queued requests to complete."""
         print("Waiting....")
         with self.condition:
-            assert self.number_of_workers
+            assert self.number_of_workers or self.autoscaler is not None
 
             for i, r in enumerate(self.known_requests):
                 print("Waiting", i, r, r.status)
@@ -168,7 +516,8 @@ class Dispatcher:
                         len(self.known_requests),
                     )
                 )
-                self.condition.wait()
+                self.condition.wait(self.timers.timeout(time.time()))
+                self._run_timers()
 
         print("Done waiting....")
 
@@ -188,9 +537,11 @@ class Dispatcher:
         with self.condition:
             assert self.paused
             self.paused = False
+            self._autoscale()
             self.condition.notify_all()
 
     def notify_environment_changed(self):
         """Called by the environment when the status of a resource is changed"""
         with self.condition:
+            self._autoscale()
             self.condition.notify_all()
@@ -0,0 +1,49 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import random
+
+
+class RetryPolicy:
+    """This class decides if and when a failed request is retried. A request is
+    retried at most 'max_retries' times, and the delay before each retry grows
+    exponentially: 'delay', 'delay * factor', 'delay * factor^2',... up to
+    'max_delay' seconds. A random 'jitter' (a fraction of the delay) is added
+    so that requests that failed together are not retried together.
+    """
+
+    def __init__(self, max_retries=3, delay=1, factor=2, max_delay=300, jitter=0.1):
+        self.max_retries = max_retries
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def replace(self, **kwargs):
+        """Returns a copy of the policy with some parameters changed"""
+        params = dict(
+            max_retries=self.max_retries,
+            delay=self.delay,
+            factor=self.factor,
+            max_delay=self.max_delay,
+            jitter=self.jitter,
+        )
+        params.update(kwargs)
+        return RetryPolicy(**params)
+
+    def backoff(self, attempt):
+        """Returns the delay in seconds before retry number 'attempt' (from 1)"""
+        delay = min(self.max_delay, self.delay * self.factor ** (attempt - 1))
+        return delay * (1 + random.uniform(0, self.jitter))
+
+    def __repr__(self):
+        return (
+            f"RetryPolicy(max_retries={self.max_retries}, delay={self.delay}, "
+            f"factor={self.factor}, max_delay={self.max_delay})"
+        )
@@ -0,0 +1,115 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import itertools
+import threading
+
+
+class ShardedQueue:
+    """A queue partitioned in shards, that can replace the list used as the
+    queue of a Dispatcher. Requests are assigned to a shard according to the
+    hash of 'key(request)', by default the user, so removing a request or
+    looking for it only scans its shard.
+
+    Each worker thread is given a home shard, round-robin. A pick takes the
+    best request of the home shard, and the best candidates of the other
+    shards, and returns the one with the highest priority, stealing it from
+    its shard if needed. The home shard wins ties.
+
+    The queue is only used with the Dispatcher condition held, and has no
+    lock of its own: a pick must happen with the condition held, until the
+    picked request is started and its limits incremented, so that another
+    worker cannot pick a request sharing a full limit in between.
+    """
+
+    def __init__(self, number_of_shards, key=None):
+        assert number_of_shards > 0
+        self.shards = [[] for _ in range(number_of_shards)]
+        self.key = key if key is not None else (lambda request: request.user)
+        # The markers that stop workers
+        self.stops = 0
+        # The home shards of the worker threads
+        self.homes = itertools.count()
+        self.local = threading.local()
+
+    def shard_for(self, request):
+        return self.shards[hash(self.key(request)) % len(self.shards)]
+
+    def home(self):
+        """Returns the home shard of the calling thread, assigned the first time
+        it is called by that thread"""
+        index = getattr(self.local, "home", None)
+        if index is None:
+            index = self.local.home = next(self.homes) % len(self.shards)
+        return self.shards[index]
+
+    def append(self, request):
+        if request is None:
+            self.stops += 1
+            return
+        self.shard_for(request).append(request)
+
+    def extend(self, requests):
+        for request in requests:
+            self.append(request)
+
+    def remove(self, request):
+        if request is None:
+            if self.stops == 0:
+                raise ValueError("No stop marker in queue")
+            self.stops -= 1
+            return
+        self.shard_for(request).remove(request)
+
+    def count(self, request):
+        if request is None:
+            return self.stops
+        return self.shard_for(request).count(request)
+
+    def __contains__(self, request):
+        return self.count(request) > 0
+
+    def __len__(self):
+        return self.stops + sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard
+
+    def pick(self, picker):
+        """Returns the next request to run, removed from its shard, or None."""
+        home = self.home()
+        picked = picker.pick(home)
+        if picked is not None and picked.canceled:
+            return picked
+
+        # Compare it with the best candidates of the other shards, at the same time
+        now = picker.clock()
+        best, best_shard, best_priority = picked, home, None
+        if picked is not None:
+            best_priority = picker.priority(picked, now)
+        for shard in self.shards:
+            if shard is home:
+                continue
+            candidate = picker.best(shard)
+            if candidate is None:
+                continue
+            if candidate.canceled:
+                best, best_shard = candidate, shard
+                break
+            priority = picker.priority(candidate, now)
+            if best is None or priority > best_priority:
+                best, best_shard, best_priority = candidate, shard, priority
+
+        if best_shard is not home:
+            # Steal it, and put back the request picked from the home shard
+            best_shard.remove(best)
+            if picked is not None:
+                home.append(picked)
+        return best
@@ -0,0 +1,218 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import argparse
+import collections
+import csv
+import heapq
+import itertools
+from array import array
+
+from queueos.broker.Environment import Environment
+from queueos.broker.Metrics import rule_name
+from queueos.broker.Request import Request, Status
+from queueos.expressions import functions
+from queueos.expressions.FunctionFactory import FUNCTIONS, FunctionFactory
+from queueos.qos.QoS import QoS
+
+
+class SimulatedRequest(Request):
+    """A request of a workload, which arrives at time 'arrival' and runs for
+    'duration' seconds. Other attributes, such as 'dataset', can be given
+    as keyword arguments, so that the rules can use them."""
+
+    def __init__(self, arrival, duration, user, cost=None, **attributes):
+        super().__init__()
+        self.start = arrival
+        self.duration = duration
+        self.user = user
+        self.cost = cost if cost is not None else (0, duration)
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+
+class Simulator:
+    """This class replays a workload through a real QoS, with a virtual clock
+    instead of worker threads, to see how a set of rules would schedule it.
+    Time jumps from one event (an arrival or the end of a request) to the
+    next, so days of activity are simulated in seconds. The ages of the
+    requests, and therefore their priorities, are computed from the virtual
+    clock.
+
+    The arrivals must be given in chronological order. They are read
+    lazily, so only the queued and running requests are kept in memory.
+    The waits are recorded per user and per limit, see report(). Like a
+    Dispatcher, the Simulator notifies its listeners of the arrival, start
+    and end of the requests.
+    """
+
+    def __init__(self, rules, number_of_workers, environment=None, qos_class=QoS):
+        self.now = 0.0
+        self.number_of_workers = number_of_workers
+        self.environment = environment if environment is not None else Environment()
+
+        self.queue = []
+        self.running = []
+        self.counter = itertools.count()
+        self.listeners = []
+
+        self.qos = qos_class(rules, self.environment, clock=lambda: self.now)
+        self.qos.attach(self)
+
+        self.user_waits = collections.defaultdict(lambda: array("d"))
+        self.limit_waits = collections.defaultdict(lambda: array("d"))
+        self.completed = 0
+        self.denied = 0
+
+    def run(self, arrivals):
+        """Simulate the workload 'arrivals', an iterable of SimulatedRequest.
+        Returns the time at which the last request ended."""
+        arrivals = iter(arrivals)
+        arrival = next(arrivals, None)
+        wakeup = None
+
+        while arrival is not None or self.running or wakeup is not None:
+            # Jump to the next event: an end, an arrival, or the time at which
+            # the QoS must re-evaluate the queue, e.g. when a rate limit refills
+            events = [] if wakeup is None else [wakeup]
+            if self.running:
+                events.append(self.running[0][0])
+            if arrival is not None:
+                events.append(arrival.start)
+            self.now = max(self.now, min(events))
+
+            while self.running and self.running[0][0] <= self.now:
+                _, _, request = heapq.heappop(self.running)
+                request.status = Status.COMPLETE
+                self.qos.notify_end_of_request(request)
+                self._notify("notify_end_of_request", request)
+                self.completed += 1
+
+            while arrival is not None and arrival.start <= self.now:
+                arrival.dispatcher = self
+                arrival.status = Status.QUEUED
+                self.queue.append(arrival)
+                self._notify("notify_enqueue_of_request", arrival)
+                arrival = next(arrivals, None)
+
+            wakeup = self._schedule()
+
+        return self.now
+
+    def _schedule(self):
+        """Start the requests that can run. Returns the time at which the queue
+        must be re-evaluated, or None"""
+        while self.queue and len(self.running) < self.number_of_workers:
+            request = self.qos.pick(self.queue)
+            if request is None:
+                # Wait for a request to end, or for the wakeup
+                return self.qos.next_wakeup(self.queue)
+
+            self.qos.notify_start_of_request(request)
+            self._notify("notify_start_of_request", request)
+            if request.canceled:
+                request.status = Status.ABORTED
+                self.qos.notify_end_of_request(request)
+                self._notify("notify_end_of_request", request)
+                self.denied += 1
+                continue
+
+            request.status = Status.ACTIVE
+            wait = self.now - request.start
+            self.user_waits[request.user].append(wait)
+            for limit in self.qos.limits_for(request):
+                self.limit_waits[rule_name(limit)].append(wait)
+
+            heapq.heappush(
+                self.running,
+                (self.now + request.duration, next(self.counter), request),
+            )
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, method, request):
+        for listener in self.listeners:
+            getattr(listener, method)(request)
+
+    def report(self, out=print):
+        """Print the distribution of the waits per user and per limit"""
+        out(f"{self.completed} requests completed, {self.denied} denied")
+        out(f"{len(self.queue)} requests could never run")
+        for title, waits in (("User", self.user_waits), ("Limit", self.limit_waits)):
+            out()
+            out(f"{title:30} {'count':>8} {'mean':>10} {'p50':>10} {'p99':>10}")
+            for name, values in sorted(waits.items()):
+                stats = distribution(values)
+                out(
+                    f"{name:30} {stats['count']:8} {stats['mean']:10.1f} "
+                    f"{stats['p50']:10.1f} {stats['p99']:10.1f}"
+                )
+
+
+def distribution(values):
+    """Returns the count, mean, median and 99th percentile of 'values'"""
+    values = sorted(values)
+    count = len(values)
+    return dict(
+        count=count,
+        mean=sum(values) / count,
+        p50=values[count // 2],
+        p99=values[min(count - 1, count * 99 // 100)],
+    )
+
+
+def read_workload(path, factory=SimulatedRequest):
+    """Reads a CSV file with the columns 'arrival', 'duration' and 'user', in
+    chronological order, such as the ones written by a Recorder. The other
+    columns become attributes of the requests, and are made available to
+    the rules as functions. Requests are created by calling 'factory'."""
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for name in reader.fieldnames:
+            builtin = f"Function{name[0].upper()}{name[1:]}"
+            if name not in FUNCTIONS and not hasattr(functions, builtin):
+                FunctionFactory.register_function(
+                    name, lambda context, name=name: getattr(context.request, name)
+                )
+        for row in reader:
+            arrival = float(row.pop("arrival"))
+            duration = float(row.pop("duration"))
+            user = row.pop("user")
+            attributes = {k: number(v) for k, v in row.items()}
+            yield factory(arrival, duration, user, **attributes)
+
+
+def number(text):
+    """Returns 'text' as an int or a float if possible"""
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Simulate a workload")
+    parser.add_argument("rules", help="the rules file")
+    parser.add_argument("workload", help="a CSV file, see read_workload()")
+    parser.add_argument("--workers", type=int, default=10)
+    args = parser.parse_args(args)
+
+    # The functions must be registered before the rules are parsed
+    arrivals = read_workload(args.workload)
+    first = next(arrivals, None)
+    simulator = Simulator(args.rules, args.workers)
+    simulator.run(itertools.chain([first] if first else [], arrivals))
+    simulator.report()
+
+
+if __name__ == "__main__":
+    main()
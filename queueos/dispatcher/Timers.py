@@ -0,0 +1,72 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import heapq
+import itertools
+
+
+class Timer:
+    """A callback scheduled at a given time. It can be canceled until it is run."""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def __repr__(self):
+        return f"Timer({self.when}, {self.callback})"
+
+
+class Timers:
+    """A heap of timers, ordered by time. This class is not thread-safe, the
+    Dispatcher only uses it with its condition held. Canceled timers are
+    simply discarded when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.heap = []
+        # Used to break ties, so timers are run in the order they were added
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.counter), timer))
+        return timer
+
+    def next_deadline(self):
+        """Returns the time of the next timer, or None if there are none"""
+        while self.heap and self.heap[0][2].canceled:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def timeout(self, now):
+        """Returns the number of seconds until the next timer, or None"""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - now)
+
+    def run_due(self, now):
+        """Run all the timers due at time 'now'. Returns the number of timers run."""
+        count = 0
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if not timer.canceled:
+                timer.callback(*timer.args)
+                count += 1
+        return count
@@ -13,6 +13,9 @@ FUNCTIONS = {}
 
 
 class UserFunction(functions.FunctionExpression):
+
+    __slots__ = ()
+
     def execute(self, context, *args):
         func = self._func[0]
         return func(context, *args)
@@ -50,7 +53,7 @@ class FunctionFactory:
     def register_function(cls, name, func):
         # For some reason, we cannot set _func to be a callable because
         # it becomes a method. So we wrap it in a list.
-        attributes = dict(_func=[func])
+        attributes = dict(_func=[func], __slots__=())
         FUNCTIONS[name] = type(
             f"Function_{name}",
             (UserFunction,),
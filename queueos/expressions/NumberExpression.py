@@ -29,6 +29,8 @@
 
 
 class NumberExpression:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -282,23 +282,83 @@ class RulesParser(Parser):
 
         rules.add_priority(environment, info, condition, conclusion)
 
+    def parse_limit_options(self, allowed=("weight",)):
+        """Parses the options between the type of a limit and its info, such as
+        'weight estimatedSize()'"""
+        options = {}
+        while self.peek() not in ("'", '"', ""):
+            option = self.parse_ident()
+            if option not in allowed or option in options:
+                raise ParserError(f"Invalid limit option: '{option}'", self.line + 1)
+            options[option] = self.parse_expression()
+        return options
+
     def parse_global_limit(self, rules, environment):
 
+        options = self.parse_limit_options(("weight", "per"))
         info = self.parse_string()
         condition = self.parse_expression()
         self.consume(":")
         conclusion = self.parse_expression()
 
-        rules.add_global_limit(environment, info, condition, conclusion)
+        rules.add_global_limit(environment, info, condition, conclusion, **options)
 
     def parse_user_limit(self, rules, environment):
 
+        options = self.parse_limit_options()
+        info = self.parse_string()
+        condition = self.parse_expression()
+        self.consume(":")
+        conclusion = self.parse_expression()
+
+        rules.add_user_limit(environment, info, condition, conclusion, **options)
+
+    def parse_retry(self, rules, environment):
+
+        info = self.parse_string()
+        condition = self.parse_expression()
+        self.consume(":")
+        conclusion = self.parse_expression()
+
+        rules.add_retry(environment, info, condition, conclusion)
+
+    def parse_queue_limit(self, rules, environment):
+
+        info = self.parse_string()
+        condition = self.parse_expression()
+        self.consume(":")
+        conclusion = self.parse_expression()
+
+        rules.add_queue_limit(environment, info, condition, conclusion)
+
+    def parse_rate(self, rules, environment):
+
+        options = self.parse_limit_options(("burst",))
+        info = self.parse_string()
+        condition = self.parse_expression()
+        self.consume(":")
+        conclusion = self.parse_expression()
+
+        rules.add_rate(environment, info, condition, conclusion, **options)
+
+    def parse_quota(self, rules, environment):
+
+        options = self.parse_limit_options(("window",))
         info = self.parse_string()
         condition = self.parse_expression()
         self.consume(":")
         conclusion = self.parse_expression()
 
-        rules.add_user_limit(environment, info, condition, conclusion)
+        rules.add_quota(environment, info, condition, conclusion, **options)
+
+    def parse_share(self, rules, environment):
+
+        info = self.parse_string()
+        condition = self.parse_expression()
+        self.consume(":")
+        conclusion = self.parse_expression()
+
+        rules.add_share(environment, info, condition, conclusion)
 
     def parse_expression(self):
         return self.parse_disjunction()
@@ -347,4 +407,24 @@ class RulesParser(Parser):
                 self.parse_user_limit(rules, environment)
                 continue
 
+            if ident == "retry":
+                self.parse_retry(rules, environment)
+                continue
+
+            if ident == "queue":
+                self.parse_queue_limit(rules, environment)
+                continue
+
+            if ident == "rate":
+                self.parse_rate(rules, environment)
+                continue
+
+            if ident == "quota":
+                self.parse_quota(rules, environment)
+                continue
+
+            if ident == "share":
+                self.parse_share(rules, environment)
+                continue
+
             raise ParserError(f"Unknown rule: '{ident}'", self.line + 1)
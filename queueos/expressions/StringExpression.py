@@ -11,6 +11,8 @@
 class StringExpression:
     """This class represents a string constant expression, e.g. 'Hello, world!'"""
 
+    __slots__ = ("value", "quote")
+
     def __init__(self, value, quote):
         self.value = value
         self.quote = quote
@@ -12,6 +12,12 @@ import re
 
 
 class FunctionExpression:
+
+    __slots__ = ("name", "args")
+
+    # True if the value only depends on the values of the arguments
+    pure = False
+
     def __init__(self, name, args):
         self.name = name
         self.args = args
@@ -30,8 +36,27 @@ class FunctionExpression:
             raise
 
 
+def leaves(expression):
+    """Returns the function calls of an expression whose values determine the
+    value of the expression, e.g. user() or available(adaptor()). Only the
+    calls of pure functions, such as operators, are broken down into their
+    arguments, as the others may also depend on the environment."""
+    if not isinstance(expression, FunctionExpression) or isinstance(
+        expression, Constant
+    ):
+        return []
+    if not expression.pure or not any(
+        isinstance(a, FunctionExpression) for a in expression.args
+    ):
+        return [expression]
+    return [leaf for a in expression.args for leaf in leaves(a)]
+
+
 #########################################################################################
 class Constant(FunctionExpression):
+
+    __slots__ = ()
+
     def execute(self, context):
         return self.value
 
@@ -46,6 +71,10 @@ class FunctionFalse(Constant):
 
 #########################################################################################
 class UnOp(FunctionExpression):
+
+    __slots__ = ()
+    pure = True
+
     def execute(self, context, a):
         return self.op(a)
 
@@ -60,6 +89,10 @@ class FunctionNot(UnOp):
 
 #########################################################################################
 class BinOp(FunctionExpression):
+
+    __slots__ = ()
+    pure = True
+
     def execute(self, context, a, b):
         return self.op(a, b)
 
@@ -132,6 +165,10 @@ class FunctionDot(BinOp):
 
 
 class Convertor(FunctionExpression):
+
+    __slots__ = ()
+    pure = True
+
     def execute(self, context, x):
         return self.scale * x
 
@@ -170,6 +207,8 @@ class FunctionTb(Convertor):
 
 #########################################################################################
 class FunctionIf(FunctionExpression):
+    pure = True
+
     def execute(self, context, condition, true, false):
         return true if condition else false
 
@@ -0,0 +1,168 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import heapq
+import itertools
+
+from queueos.dispatcher.ShardedQueue import ShardedQueue
+from queueos.qos.QoS import QoS, locked
+
+
+class UserShare:
+    """The queued requests of a user, and the service it received"""
+
+    __slots__ = ("user", "weight", "virtual", "requests")
+
+    def __init__(self, user, weight, virtual):
+        self.user = user
+        self.weight = weight
+        # Number of requests started, divided by the weight
+        self.virtual = virtual
+        # Used as an ordered set
+        self.requests = {}
+
+
+class Backlog:
+    """Keeps the queued requests of each user of a FairShareQoS up to date, as
+    a listener of the Dispatcher"""
+
+    def __init__(self, qos):
+        self.qos = qos
+
+    def notify_enqueue_of_request(self, request):
+        self.qos.enqueued(request)
+
+    def notify_start_of_request(self, request):
+        self.qos.dequeued(request)
+
+    def notify_end_of_request(self, request):
+        self.qos.dequeued(request)
+
+
+class FairShareQoS(QoS):
+    """A QoS that shares the workers between the users with waiting requests,
+    in proportion to the weights given by the 'share' rules, instead of
+    running the request of highest priority first. This is weighted fair
+    queuing, where the service is counted in started requests: each user
+    has a virtual time, increased by 1/weight when one of its requests
+    starts, and the next request is taken from the user with the lowest
+    virtual time that has a request that can run. A user with no request
+    waiting is forgotten, and starts again at the current virtual time, so
+    it cannot save up service while idle.
+
+    The users are kept in a heap, so selecting the next user is O(log users)
+    when it has a runnable request. The requests of that user are compared
+    by priority, like in QoS.best(). Limits and permissions apply as usual.
+
+    The QoS follows the queue of the Dispatcher as one of its listeners, see
+    attach(), so the queue must be a list, not a ShardedQueue.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # The users with requests waiting, and a heap of (virtual time, sequence,
+        # share) where entries are stale when the virtual time of the share changed
+        self.shares = {}
+        self.order = []
+        self.sequence = itertools.count()
+        # The virtual time of the last user served
+        self.virtual = 0.0
+        super().__init__(*args, **kwargs)
+
+    def attach(self, dispatcher):
+        assert not isinstance(dispatcher.queue, ShardedQueue)
+        dispatcher.add_listener(Backlog(self))
+
+    @locked
+    def reconfigure(self):
+        super().reconfigure()
+        for share in self.shares.values():
+            share.weight = None
+
+    def _weight(self, request):
+        for rule in self.rules.shares:
+            if rule.match(request):
+                return rule.evaluate(request)
+        return 1
+
+    def _push(self, share):
+        heapq.heappush(self.order, (share.virtual, next(self.sequence), share))
+
+    @locked
+    def enqueued(self, request):
+        share = self.shares.get(request.user)
+        if share is None:
+            share = UserShare(request.user, self._weight(request), self.virtual)
+            self.shares[request.user] = share
+            self._push(share)
+        share.requests[request] = None
+
+    @locked
+    def dequeued(self, request):
+        share = self.shares.get(request.user)
+        if share is None or request not in share.requests:
+            return
+        del share.requests[request]
+        if not share.requests:
+            del self.shares[request.user]
+
+    @locked
+    def best(self, queue):
+        """Returns the request that should run next, taken from the user with the
+        lowest virtual time that has a request that can run, or None"""
+        best = None
+        skipped = []
+        while self.order:
+            virtual, _, share = self.order[0]
+            if share.virtual != virtual or self.shares.get(share.user) is not share:
+                heapq.heappop(self.order)
+                continue
+            best = self._best_of(share)
+            if best is not None:
+                break
+            skipped.append(heapq.heappop(self.order))
+
+        for entry in skipped:
+            heapq.heappush(self.order, entry)
+        return best
+
+    def _best_of(self, share):
+        now = self.clock()
+        best, best_priority = None, None
+        cache = self.requests_properties_cache
+        for request in share.requests:
+            properties = cache.get(request) or self._properties(request)
+            if request.canceled:
+                return request
+            blocked = self._full_limit(request, properties)
+            if blocked is not None:
+                if self.tracer is not None:
+                    self.tracer.blocked(request, blocked)
+                continue
+            priority = properties.starting_priority + request.age_at(now)
+            if best is None or priority > best_priority:
+                best, best_priority = request, priority
+        return best
+
+    @locked
+    def notify_start_of_request(self, request):
+        super().notify_start_of_request(request)
+        share = self.shares.get(request.user)
+        if share is None:
+            return
+        if share.weight is None:
+            share.weight = self._weight(request)
+        self.virtual = max(self.virtual, share.virtual)
+        share.virtual += 1 / share.weight
+        self._push(share)
+
+    @locked
+    def metrics(self):
+        metrics = super().metrics()
+        metrics.update(shares=len(self.shares), order=len(self.order))
+        return metrics
@@ -0,0 +1,78 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+from array import array
+
+
+class Ledger:
+    """The usage accumulated over a sliding window of 'window' seconds, kept
+    in a ring of 'buckets' time buckets, by default one per minute of a day.
+    The total of the buckets in the window is maintained as buckets expire,
+    so reading the usage is O(1), amortised over the time that passed. The
+    window slides by one bucket at a time.
+    """
+
+    __slots__ = ("width", "buckets", "last", "total")
+
+    def __init__(self, window, buckets=1440):
+        self.width = window / buckets
+        self.buckets = array("d", bytes(8 * buckets))
+        # The absolute index of the most recent bucket, i.e. time // width
+        self.last = None
+        self.total = 0.0
+
+    def _advance(self, now):
+        last = int(now // self.width)
+        if self.last is None or last - self.last >= len(self.buckets):
+            for i in range(len(self.buckets)):
+                self.buckets[i] = 0
+            self.total = 0.0
+        elif last > self.last:
+            for i in range(self.last + 1, last + 1):
+                slot = i % len(self.buckets)
+                self.total -= self.buckets[slot]
+                self.buckets[slot] = 0
+        if self.last is None or last > self.last:
+            self.last = last
+
+    def add(self, start, end):
+        """Record a usage between 'start' and 'end', spread over the buckets
+        that cover that time. The part before the window is ignored."""
+        self._advance(end)
+        count = len(self.buckets)
+        t = max(start, (self.last - count + 1) * self.width)
+        i = int(t // self.width)
+        while t < end:
+            boundary = (i + 1) * self.width
+            amount = min(end, boundary) - t
+            if amount > 0:
+                self.buckets[i % count] += amount
+                self.total += amount
+            t = boundary
+            i += 1
+
+    def usage(self, now):
+        """Returns the usage in the window ending at 'now'"""
+        self._advance(now)
+        return max(0.0, self.total)
+
+    def below(self, capacity, now):
+        """Returns the time at which the usage will drop below 'capacity' if
+        nothing is added, or None if it never does"""
+        self._advance(now)
+        count = len(self.buckets)
+        total = self.total
+        if total < capacity:
+            return now
+        for i in range(self.last - count + 1, self.last + 1):
+            total -= self.buckets[i % count]
+            if total < capacity:
+                # Bucket 'i' leaves the window when bucket 'i + count' starts
+                return (i + count) * self.width
+        return None
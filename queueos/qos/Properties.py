@@ -9,10 +9,23 @@
 
 
 class Properties:
-    """This class is a placeholder to hold all rules that matches a given request."""
+    """This class holds all rules that matches a given request. Properties are
+    immutable, so requests matching the same rules share the same instance
+    (see QoS._properties). The rules are held in tuples."""
 
-    def __init__(self):
-        self.starting_priority = 0
-        self.limits = []
-        self.priorities = []
-        self.permissions = []
+    __slots__ = (
+        "starting_priority",
+        "limits",
+        "priorities",
+        "permissions",
+        "__weakref__",
+    )
+
+    def __init__(self, starting_priority=0, limits=(), priorities=(), permissions=()):
+        self.starting_priority = starting_priority
+        self.limits = limits
+        self.priorities = priorities
+        self.permissions = permissions
+
+    def key(self):
+        return (self.starting_priority, self.limits, self.priorities, self.permissions)
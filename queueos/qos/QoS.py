@@ -7,12 +7,21 @@
 # nor does it submit to any jurisdiction.
 #
 
+import collections
+import math
 import threading
+import time
+import weakref
 from functools import wraps
 
+from queueos.dispatcher.RetryPolicy import RetryPolicy
+from queueos.expressions.functions import leaves
 from queueos.expressions.RulesParser import RulesParser
 from queueos.qos.Properties import Properties
-from queueos.qos.Rule import Context, RuleSet
+from queueos.qos.Rule import Context, Counter, QuotaLimit, RuleSet, UserLimit
+
+# Maximum number of outcomes of the permission rules kept in the cache
+PERMISSIONS_CACHE_SIZE = 100000
 
 
 def locked(method):
@@ -25,22 +34,75 @@ def locked(method):
 
 
 class QoS:
-    def __init__(self, rules, environment):
-        self.lock = threading.RLock()
+    def __init__(
+        self,
+        rules,
+        environment,
+        counters=None,
+        clock=time.time,
+        metrics=None,
+        backfill=False,
+    ):
+        """
+
+        Args:
+            rules ([type]): a RuleSet, or the path of a rules file
+            environment ([type]): the environment in which the rules are evaluated
+            counters ([type]): optional backend holding the values of the limits, such as
+                SharedCounters. By default, the values are private to the process.
+            clock ([type]): the function returning the current time used to compute
+                priorities. Requests should use the same clock, see Request.clock.
+            metrics ([type]): optional Metrics recording the wait and hold times of the lock
+            backfill ([type]): if True, a request blocked by a full limit reserves it, see best()
+        """
+        if metrics is None:
+            self.lock = threading.RLock()
+        else:
+            self.lock = metrics.timed_lock("qos")
 
         self.environment = environment
-        # The list of active requests
-        self.running_requests = set()
+        self.counters = counters
+        self.clock = clock
+        self.backfill = backfill
+        # The active requests, and the time at which they started
+        self.running_requests = dict()
 
         # Cache associating Request and their Properties
         self.requests_properties_cache = dict()
 
+        # The distinct Properties, shared by requests matching the same rules
+        self.properties_pool = weakref.WeakValueDictionary()
+
+        # Outcome of the permission rules, per values of the functions they use
+        self.permissions_cache = dict()
+        self.permissions_key = None
+
         # Mapping between user names and corresponding per-user limit
         self.per_user_limits = dict()
 
+        # Number of requests holding the per-user limit of each user. The
+        # limit of a user is evicted when it drops to zero.
+        self.per_user_requests = collections.Counter()
+
+        # The instances of the keyed limits, with their rule and key, and the
+        # number of requests holding each of them, see _keyed_limit()
+        self.keyed_limits = dict()
+        self.keyed_requests = collections.Counter()
+
+        # Optional Tracer recording the limits blocking queued requests
+        self.tracer = None
+
+        # The limits freed with time, such as rate limits, that blocked requests
+        # during the last pick, with one of these requests. See next_wakeup().
+        self.blocking = dict()
+
+        # Backoff of the retries set by rules, which only give the number of retries
+        self.retry_policy = RetryPolicy()
+
         if isinstance(rules, RuleSet):
             self.path = None
             self.rules = rules
+            self._bind_counters()
         else:
             self.path = rules
             self.rules = None
@@ -54,11 +116,15 @@ class QoS:
         # Create a parser to parse the rules file
         parser = RulesParser(self.path)
 
-        # The rules will be stored in self.rules
+        # The rules will be stored in self.rules, the rate limits and quotas
+        # keep their state
+        previous = self.rules
         self.rules = RuleSet()
 
         # Parse the rules
         parser.parse_rules(self.rules, self.environment)
+        self._bind_counters(previous)
+        self.permissions_key = None
 
         # Print the rules
         self.rules.dump()
@@ -79,15 +145,76 @@ class QoS:
 
         # Reset per-user limits
         self.per_user_limits.clear()
+        self.per_user_requests.clear()
+
+        # Reset keyed limits
+        for limit in self.rules.global_limits:
+            limit.instances.clear()
+        self.keyed_limits.clear()
+        self.keyed_requests.clear()
+
+        # Reset the values of the limits, but not the state of the rate limits
+        # and quotas
+        self._bind_counters(self.rules)
+        for rule in self.rules.quotas:
+            rule.running.clear()
 
         # Invalidate all caches, so the  rules will be applied
         self.requests_properties_cache.clear()
+        self.properties_pool.clear()
+        self.permissions_cache.clear()
+        self.permissions_key = None
 
         # Re-register the active tasks
-        for request in self.running_requests:
-            # Recompute the limits
+        for request, since in self.running_requests.items():
+            # Recompute the limits. The rate limits kept their buckets, and
+            # the quotas count the run time from the start of the requests.
             for limit in self.limits_for(request):
-                limit.increment()
+                if isinstance(limit, QuotaLimit):
+                    limit.start(request, since)
+                elif not limit.refills:
+                    limit.increment(limit.amount(request))
+
+    def attach(self, dispatcher):
+        """Called by the Broker once 'dispatcher' is created, so that subclasses
+        can follow its queue, see FairShareQoS"""
+
+    def _bind_counters(self, previous=None):
+        """Give fresh counters to the global limits. With a shared backend, the
+        contributions of this process are reset, and the counters are found by
+        name, so that the processes sharing the backend share the limits.
+
+        The rate limits and quotas take over the token buckets and ledgers of
+        the rules of the same type and info in the 'previous' rule set, and
+        start afresh otherwise."""
+        if self.counters is not None:
+            self.counters.reset()
+
+        for limit in self.rules.global_limits:
+            limit.counter = self._counter(f"limit:{limit.info}")
+
+        kept = {}
+        if previous is not None:
+            for rule in previous.rates + previous.quotas:
+                kept[(rule.name, str(rule.info))] = rule
+
+        for rule in self.rules.rates + self.rules.quotas:
+            old = kept.get((rule.name, str(rule.info)))
+            if old is None:
+                rule.reset()
+            elif old is not rule:
+                rule.inherit(old)
+            rule.clock = self.clock
+
+    def _counter(self, key):
+        if self.counters is None:
+            return Counter()
+        return self.counters.counter(key)
+
+    def _release(self, key):
+        """Release the counter of a limit that was evicted"""
+        if self.counters is not None:
+            self.counters.release(key)
 
     @locked
     def can_run(self, request):
@@ -105,48 +232,110 @@ class QoS:
         if properties is not None:
             return properties
 
-        properties = Properties()
+        context = Context(request, self.environment)
+        limits = []
+        priorities = []
 
         # First check permissions
-        for rule in self.rules.permissions:
-            if rule.match(request):
-                properties.permissions.append(rule)
-                if not rule.evaluate(request):
-                    request.canceled = rule.info.evaluate(
-                        Context(request, self.environment)
-                    )
-                    break
+        permissions, denial = self._permissions(request, context)
+        if denial is not None:
+            request.canceled = denial
 
         # Add general limits
         for rule in self.rules.global_limits:
-            if rule.match(request):
-                properties.limits.append(rule)
+            if rule.match(request, context):
+                if rule.per is None:
+                    limits.append(rule)
+                else:
+                    limits.append(self._keyed_limit(rule, request, context))
+
+        # Add rate limits and quotas
+        for rule in self.rules.rates + self.rules.quotas:
+            if rule.match(request, context):
+                limits.append(rule)
 
         # Add per-user limits
         limit = self.user_limit(request)
         if limit is not None:
-            properties.limits.append(limit)
+            limits.append(limit)
+            self.per_user_requests[request.user] += 1
 
         # Add priorities and compute starting priority
         priority = 0
         for rule in self.rules.priorities:
-            if rule.match(request):
-                properties.priorities.append(rule)
-                priority += rule.evaluate(request)
-
-        # Set starting priority
-        properties.starting_priority = priority
+            if rule.match(request, context):
+                priorities.append(rule)
+                priority += rule.evaluate(request, context)
+
+        # Share the properties between requests matching the same rules
+        properties = Properties(
+            priority,
+            tuple(limits),
+            tuple(priorities),
+            permissions,
+        )
+        properties = self.properties_pool.setdefault(properties.key(), properties)
 
         # Store in cache
         self.requests_properties_cache[request] = properties
 
         return properties
 
+    def _permissions(self, request, context):
+        """Returns the permission rules matching a request, and the reason why it
+        is denied, or None. The outcome only depends on the values of the
+        function calls of the rules, e.g. user() or available(adaptor()), see
+        leaves(), so it is cached per tuple of these values."""
+        if self.permissions_key is None:
+            calls = {}
+            for rule in self.rules.permissions:
+                for expression in (rule.condition, rule.conclusion, rule.info):
+                    for leaf in leaves(expression):
+                        calls.setdefault(repr(leaf), leaf)
+            self.permissions_key = tuple(calls.values())
+
+        try:
+            key = tuple(call.evaluate(context) for call in self.permissions_key)
+            cached = self.permissions_cache.get(key)
+        except Exception:
+            # Unhashable values, or functions that do not apply to this request
+            key, cached = None, None
+        if cached is not None:
+            return cached
+
+        permissions = []
+        denial = None
+        for rule in self.rules.permissions:
+            if rule.match(request, context):
+                permissions.append(rule)
+                if not rule.evaluate(request, context):
+                    denial = rule.info.evaluate(context)
+                    break
+
+        result = (tuple(permissions), denial)
+        if key is not None:
+            if len(self.permissions_cache) >= PERMISSIONS_CACHE_SIZE:
+                self.permissions_cache.clear()
+            self.permissions_cache[key] = result
+        return result
+
     @locked
-    def priority(self, request):
-        """Computes the priority of a request"""
+    def prepare(self, requests):
+        """Compute and cache the properties of requests about to be queued, so
+        that it is not done while the Dispatcher is locked. This also checks
+        their permissions: denied requests have their 'canceled' attribute set,
+        and are not queued by the Dispatcher."""
+        for request in requests:
+            self._properties(request)
+
+    @locked
+    def priority(self, request, now=None):
+        """Computes the priority of a request at time 'now', by default the
+        current time of the clock of the QoS"""
+        if now is None:
+            now = self.clock()
         # The priority of a request increases with time
-        return self._properties(request).starting_priority + request.age
+        return self._properties(request).starting_priority + request.age_at(now)
 
     def dump(self, out=print):
         self.rules.dump(out)
@@ -208,6 +397,18 @@ class QoS:
         properties cache is created if needed."""
         return self._properties(request).priorities
 
+    def _keyed_limit(self, rule, request, context):
+        """Returns the instance of a keyed limit for the key of a request"""
+        key = rule.key(request, context)
+        limit = rule.instances.get(key)
+        if limit is None:
+            limit = rule.clone()
+            limit.counter = self._counter(f"limit:{rule.info}:{key}")
+            rule.instances[key] = limit
+            self.keyed_limits[limit] = (rule, key)
+        self.keyed_requests[limit] += 1
+        return limit
+
     @locked
     def user_limit(self, request):
         """Returns the per-user limit for the user associated with the request"""
@@ -215,7 +416,6 @@ class QoS:
 
         limit = self.per_user_limits.get(user)
         if limit is not None:
-            print(user, limit)
             return limit
 
         for limit in self.rules.user_limits:
@@ -225,35 +425,115 @@ class QoS:
                 user otherwise all users will share that limit
                 """
                 limit = limit.clone()
+                limit.counter = self._counter(f"user:{user}:{limit.info}")
                 self.per_user_limits[user] = limit
                 return limit
         return None
         # raise Exception(f"Not rules matching user '{user}'")
 
     @locked
-    def pick(self, queue):
+    def best(self, queue):
+        """Returns the request of the queue that should run next, without removing
+        it, or None if no request can run. Canceled requests are returned first,
+        so that they can be failed."""
 
         for request in queue:
             if request.canceled:
-                queue.remove(request)
                 return request
 
-        # Create the list of requests than can run
-        candidates = [r for r in queue if self.can_run(r)]
+        if self.backfill:
+            return self._backfill(queue)
+
+        # Select the request that can run with the highest priority. The clock is
+        # read once, so that all the candidates are compared at the same time
+        now = self.clock()
+        best, best_priority = None, None
+        cache = self.requests_properties_cache
+        for request in queue:
+            properties = cache.get(request) or self._properties(request)
+            blocked = self._full_limit(request, properties)
+            if blocked is not None:
+                if self.tracer is not None:
+                    self.tracer.blocked(request, blocked)
+                continue
+            priority = properties.starting_priority + request.age_at(now)
+            if best is None or priority > best_priority:
+                best, best_priority = request, priority
 
         # If no request can run, return 'None'
-        if len(candidates) == 0:
-            return None
+        return best
+
+    def _backfill(self, queue):
+        """Like best(), but when the request of highest priority is blocked by a
+        full limit, it reserves its limits: the other requests can only run if
+        they are expected to end, from their estimatedTime(), before the
+        running requests free enough of the limits for it, or if they leave
+        enough room for it at that time. This is EASY backfilling."""
+        now = self.clock()
+        head, head_priority = None, None
+        candidates = []
+        cache = self.requests_properties_cache
+        for request in queue:
+            properties = cache.get(request) or self._properties(request)
+            priority = properties.starting_priority + request.age_at(now)
+            if self._full_limit(request, properties) is None:
+                candidates.append((priority, request))
+            if head is None or priority > head_priority:
+                head, head_priority = request, priority
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        if not candidates or candidates[0][1] is head:
+            return candidates[0][1] if candidates else None
+
+        if self.tracer is not None:
+            self.tracer.blocked(head, self._full_limit(head, cache[head]))
+
+        when, values = self._reservation(head, now)
+        for _, request in candidates:
+            if now + request.cost[1] <= when:
+                return request
+            if not any(
+                limit.full(head, values[limit] + limit.amount(request))
+                for limit in self.limits_for(request)
+                if limit in values
+            ):
+                return request
+        return None
 
-        # Sort according to priorities, highest first
-        candidates = sorted(
-            candidates,
-            key=lambda r: self.priority(r),
-            reverse=True,
+    def _reservation(self, head, now):
+        """Returns the time at which the running requests are expected to have
+        freed enough of the limits of 'head' for it to run, and the expected
+        values of these limits at that time"""
+        limits = [limit for limit in self.limits_for(head) if not limit.refills]
+        values = {limit: limit.value for limit in limits}
+        running = self.running_requests.items()
+        ends = sorted(
+            ((since + request.cost[1], request) for request, since in running),
+            key=lambda end: end[0],
         )
+        for end, request in ends:
+            for limit in self.limits_for(request):
+                if limit in values:
+                    values[limit] -= limit.amount(request)
+            if not any(limit.full(head, values[limit]) for limit in limits):
+                return max(end, now), values
+        return math.inf, values
+
+    def _full_limit(self, request, properties):
+        for limit in properties.limits:
+            if limit.full(request):
+                if limit.refills:
+                    self.blocking[(limit, request.user)] = request
+                return limit
+        return None
 
-        # Select the request with the highest priority
-        request = candidates[0]
+    @locked
+    def pick(self, queue):
+
+        self.blocking.clear()
+        request = self.best(queue)
+        if request is None:
+            return None
 
         # Remove it from the queue
         queue.remove(request)
@@ -262,26 +542,108 @@ class QoS:
 
         return request
 
+    @locked
+    def queue_limits_for(self, request):
+        """Returns the queue rules that apply to a request"""
+        return [rule for rule in self.rules.queue_limits if rule.match(request)]
+
+    @locked
+    def retry_policy_for(self, request):
+        """Returns the RetryPolicy of a failed request, or None if it must not be
+        retried. The policy set on the request takes precedence over the rules."""
+        if request.retry_policy is not None:
+            return request.retry_policy
+
+        for rule in self.rules.retries:
+            if rule.match(request):
+                return self.retry_policy.replace(max_retries=rule.evaluate(request))
+        return None
+
+    def next_wakeup(self, queue):
+        """Returns the time at which the queue must be re-evaluated when pick()
+        returned no request, or None if only an event (a request ending, a change
+        in the environment,...) can make a queued request runnable. As the
+        priorities of all requests grow at the same rate, their order does
+        not change with time, so no wakeup is needed for aging. The rate
+        limits and quotas that blocked requests are freed with time, so the
+        queue is re-evaluated when the first of them lets a request run again.
+        """
+        with self.lock:
+            wakeups = [
+                limit.next_refill(request)
+                for (limit, _), request in self.blocking.items()
+            ]
+        return min((w for w in wakeups if w is not None), default=None)
+
     @locked
     def notify_start_of_request(self, request):
         """Increments the limits matching that request so that other request
         sharing the same limits may be kept in the queue if a limit reaches
         its capacity
         """
+        now = self.clock()
         for limit in self.limits_for(request):
-            limit.increment()
+            limit.increment(limit.amount(request))
+            if isinstance(limit, QuotaLimit):
+                limit.start(request, now)
 
         # Keep track of the running request. This is needed by reconfigure(self)
-        self.running_requests.add(request)
+        self.running_requests[request] = now
 
     @locked
     def notify_end_of_request(self, request):
         """Decrements the limits matching that request so that other request
         sharing the same limits can run
         """
+        since = self.running_requests.pop(request)
         for limit in self.limits_for(request):
-            limit.decrement()
+            limit.decrement(limit.amount(request))
+            if isinstance(limit, QuotaLimit):
+                limit.charge(request, since, self.clock())
 
         # Remove requests all collections
-        self.running_requests.remove(request)
-        self.requests_properties_cache.pop(request)
+        self._forget(request)
+
+    @locked
+    def notify_cancel_of_request(self, request):
+        """Called when a request leaves the queue without running, e.g. when it
+        is canceled by the client, so that its properties are freed"""
+        self._forget(request)
+
+    def _forget(self, request):
+        properties = self.requests_properties_cache.pop(request, None)
+        if properties is None:
+            return
+
+        # Evict the per-user limit when no other request of the user holds it.
+        # Requests hold it until they end, so the value of the limit is zero.
+        if any(isinstance(limit, UserLimit) for limit in properties.limits):
+            user = request.user
+            self.per_user_requests[user] -= 1
+            if self.per_user_requests[user] <= 0:
+                del self.per_user_requests[user]
+                limit = self.per_user_limits.pop(user, None)
+                if limit is not None:
+                    self._release(f"user:{user}:{limit.info}")
+
+        # Same for the instances of keyed limits
+        for limit in properties.limits:
+            if limit in self.keyed_limits:
+                self.keyed_requests[limit] -= 1
+                if self.keyed_requests[limit] <= 0:
+                    del self.keyed_requests[limit]
+                    rule, key = self.keyed_limits.pop(limit)
+                    rule.instances.pop(key, None)
+                    self._release(f"limit:{rule.info}:{key}")
+
+    @locked
+    def metrics(self):
+        """Returns the sizes of the caches of the QoS as a dictionary."""
+        return dict(
+            running_requests=len(self.running_requests),
+            requests_properties=len(self.requests_properties_cache),
+            properties_pool=len(self.properties_pool),
+            per_user_limits=len(self.per_user_limits),
+            keyed_limits=len(self.keyed_limits),
+            permissions=len(self.permissions_cache),
+        )
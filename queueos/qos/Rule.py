@@ -7,13 +7,33 @@
 # nor does it submit to any jurisdiction.
 #
 
+import time
+
+from queueos.qos.Ledger import Ledger
+
 
 class Context:
+
+    __slots__ = ("request", "environment")
+
     def __init__(self, request, environment):
         self.request = request
         self.environment = environment
 
 
+class Counter:
+    """The counter of a limit, private to the process. See SharedCounters for
+    counters shared between processes."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount):
+        self.value = max(0, self.value + amount)
+
+
 class QoSRule:
     """
     This class represents an  QoS rule. Rules have two parts: the
@@ -30,23 +50,38 @@ class QoSRule:
     an expression, so it can be evaluated dynamically later.
     """
 
+    __slots__ = ("environment", "info", "condition", "conclusion")
+
     def __init__(self, environment, info, condition, conclusion):
         self.environment = environment
         self.info = info
         self.condition = condition
         self.conclusion = conclusion
 
-    def evaluate(self, request):
-        return self.conclusion.evaluate(Context(request, self.environment))
+    def evaluate(self, request, context=None):
+        if context is None:
+            context = Context(request, self.environment)
+        return self.conclusion.evaluate(context)
 
-    def match(self, request):
-        return self.condition.evaluate(Context(request, self.environment))
+    def match(self, request, context=None):
+        if context is None:
+            context = Context(request, self.environment)
+        return self.condition.evaluate(context)
 
     def dump(self, out):
         out(self)
 
+    def options(self):
+        """Returns the options of the rule, written between its type and its info"""
+        return {}
+
     def __repr__(self):
-        return f"{self.name} {self.info} {self.condition} : {self.conclusion}"
+        options = "".join(
+            f"{name} {value} "
+            for name, value in self.options().items()
+            if value is not None
+        )
+        return f"{self.name} {options}{self.info} {self.condition} : {self.conclusion}"
 
 
 class Priority(QoSRule):
@@ -71,6 +106,8 @@ class Priority(QoSRule):
     requests.
     """
 
+    __slots__ = ()
+
     name = "priority"
 
 
@@ -82,9 +119,52 @@ class Permission(QoSRule):
     and are immediately set to aborted.
     """
 
+    __slots__ = ()
+
     name = "permission"
 
 
+class Retry(QoSRule):
+    """
+    This class implements the retry rule. Its 'conclusion' must evaluate
+    to the maximum number of times a failed request matching the
+    'condition' is put back in the queue. The delay before each retry
+    grows exponentially. Only the first matching rule is considered.
+    """
+
+    __slots__ = ()
+
+    name = "retry"
+
+
+class QueueLimit(QoSRule):
+    """
+    This class implements an admission limit. Its 'conclusion' must
+    evaluate to the maximum number of requests matching the 'condition'
+    that can wait in the queue at the same time. What happens to the
+    requests beyond it depends on the policy of the Admission of the
+    Dispatcher.
+    """
+
+    __slots__ = ()
+
+    name = "queue"
+
+
+class Share(QoSRule):
+    """
+    This class implements the share rule, used by the FairShareQoS. Its
+    'conclusion' must evaluate to the weight of the user of the matching
+    requests: a user of weight 2 runs twice as many requests as a user of
+    weight 1 when both have requests waiting. Only the first matching rule
+    is considered, and users matching no rule have a weight of 1.
+    """
+
+    __slots__ = ()
+
+    name = "share"
+
+
 class Limit(QoSRule):
     """
     This class implements a limit in the QoS system. Its 'conclusion'
@@ -96,39 +176,115 @@ class Limit(QoSRule):
     matching the 'condition' part of the rule is started, and decremented
     when the request finishes. If the counter value reaches the maximum
     capacity of the limit, no requests matching that limit can run.
+
+    If the limit has a 'weight' expression, such as 'estimatedSize()', the
+    counter moves by its value for each request instead of by one, and a
+    request can only run if its weight fits in the remaining capacity. A
+    request heavier than the whole capacity can still run alone, so that
+    it is not blocked forever.
     """
 
-    def __init__(self, environment, info, condition, conclusion):
+    __slots__ = ("counter", "last_capacity", "weight")
+
+    # Whether the limit frees itself with time, see QoS.next_wakeup()
+    refills = False
+
+    def __init__(self, environment, info, condition, conclusion, weight=None):
         super().__init__(environment, info, condition, conclusion)
-        self.value = 0
+        self.counter = Counter()
+        # The capacity of a limit may depend on the request, so the one of the
+        # last request checked is kept for the metrics
+        self.last_capacity = None
+        self.weight = weight
 
-    def increment(self):
-        self.value += 1
+    @property
+    def value(self):
+        return self.counter.value
 
-    def decrement(self):
-        if self.value > 0:
-            self.value -= 1
+    def amount(self, request):
+        """Returns how much of the limit a request takes while it runs"""
+        if self.weight is None:
+            return 1
+        return self.weight.evaluate(Context(request, self.environment))
+
+    def increment(self, amount=1):
+        self.counter.add(amount)
+
+    def decrement(self, amount=1):
+        self.counter.add(-amount)
 
     def capacity(self, request):
         return self.evaluate(request)
 
-    def full(self, request):
+    def full(self, request, value=None):
+        """Returns True if 'request' cannot run because the limit is full. If
+        'value' is given, it is used instead of the value of the counter."""
         # NOTE: the self.value can be greater than the limit capacity after a
         # reconfiguration of the QoS
-        return self.value >= self.capacity(request)
+        self.last_capacity = self.capacity(request)
+        if value is None:
+            value = self.value
+        if value >= self.last_capacity:
+            return True
+        if self.weight is None or value == 0:
+            return False
+        return value + self.amount(request) > self.last_capacity
+
+    def options(self):
+        return dict(weight=self.weight)
 
 
 class GlobalLimit(Limit):
     """
     This is a subclass of 'Limit' and exists for the sake of strong
     typing. Global limits are shared by all users.
+
+    With a 'per' expression, such as 'dataset()', the rule is a keyed
+    limit: each distinct value of the expression has its own instance of
+    the limit, with its own counter, so one rule replaces a rule per
+    value. The QoS evaluates the key once per request, and keeps the
+    instances in 'instances' while requests hold them.
     """
 
+    __slots__ = ("per", "instances")
+
     name = "limit"
 
+    def __init__(
+        self,
+        environment,
+        info,
+        condition,
+        conclusion,
+        weight=None,
+        per=None,
+    ):
+        super().__init__(environment, info, condition, conclusion, weight)
+        self.per = per
+        self.instances = {}
+
+    def key(self, request, context=None):
+        if context is None:
+            context = Context(request, self.environment)
+        return self.per.evaluate(context)
+
+    def clone(self):
+        return GlobalLimit(
+            self.environment,
+            self.info,
+            self.condition,
+            self.conclusion,
+            self.weight,
+        )
+
+    def options(self):
+        return dict(weight=self.weight, per=self.per)
+
 
 class UserLimit(Limit):
 
+    __slots__ = ()
+
     name = "user"
 
     def clone(self):
@@ -137,9 +293,228 @@ class UserLimit(Limit):
             self.info,
             self.condition,
             self.conclusion,
+            self.weight,
         )
 
 
+class RateLimit(QoSRule):
+    """
+    This class implements a rate limit, backed by a token bucket. Its
+    'conclusion' must evaluate to the number of requests matching the
+    'condition' that can start per second. The bucket holds 'burst'
+    tokens, by default one second worth of starts, so that up to 'burst'
+    requests can start at once after a quiet period. Each start takes a
+    token, and ends give nothing back.
+
+    The bucket is private to the process, and refilled from the clock of
+    the QoS, see QoS.next_wakeup().
+    """
+
+    __slots__ = ("burst", "tokens", "updated", "last_rate", "last_capacity", "clock")
+
+    name = "rate"
+
+    refills = True
+
+    def __init__(self, environment, info, condition, conclusion, burst=None):
+        super().__init__(environment, info, condition, conclusion)
+        self.burst = burst
+        self.clock = time.time
+        self.reset()
+
+    def reset(self):
+        # The bucket is full at first use
+        self.tokens = None
+        self.updated = None
+        self.last_rate = None
+        self.last_capacity = None
+
+    def inherit(self, rule):
+        """Take over the bucket of 'rule', the same rule in a previous rule set"""
+        self.tokens = rule.tokens
+        self.updated = rule.updated
+        self.last_rate = rule.last_rate
+        self.last_capacity = rule.last_capacity
+
+    def capacity(self, request):
+        if self.burst is None:
+            return max(1, self.evaluate(request))
+        return self.burst.evaluate(Context(request, self.environment))
+
+    def _refill(self, request):
+        now = self.clock()
+        self.last_rate = self.evaluate(request)
+        self.last_capacity = self.capacity(request)
+        if self.tokens is None:
+            self.tokens = self.last_capacity
+        else:
+            elapsed = max(0, now - self.updated)
+            self.tokens = min(
+                self.last_capacity, self.tokens + elapsed * self.last_rate
+            )
+        self.updated = now
+
+    @property
+    def value(self):
+        """The number of tokens taken from the bucket, when it was last refilled"""
+        if self.tokens is None:
+            return 0
+        return self.last_capacity - self.tokens
+
+    def amount(self, request):
+        return 1
+
+    def increment(self, amount=1):
+        self.tokens -= amount
+
+    def decrement(self, amount=1):
+        pass
+
+    def full(self, request, value=None):
+        self._refill(request)
+        tokens = self.tokens if value is None else self.last_capacity - value
+        # Tolerate rounding errors, so that a token is available at the time
+        # given by next_refill()
+        return tokens < 1 - 1e-9
+
+    def next_refill(self, request):
+        """Returns the time at which the next token will be available"""
+        if self.tokens is None or self.tokens >= 1:
+            return self.updated
+        if not self.last_rate or self.last_rate <= 0:
+            return None
+        return self.updated + (1 - self.tokens) / self.last_rate
+
+    def options(self):
+        return dict(burst=self.burst)
+
+
+class QuotaLimit(QoSRule):
+    """
+    This class implements a usage quota. Its 'conclusion' must evaluate to
+    the number of seconds of run time that each user can consume with the
+    requests matching the 'condition', over a sliding window of 'window'
+    seconds, by default a day. For example, 'hour(20)' allows 20 worker-hours
+    per rolling 24 hours. The run time of a request is measured between
+    its start and its end, and recorded in the Ledger of its user when it
+    ends. While it runs, the time elapsed since its start counts as well,
+    from the number of running requests of the user and the sum of their
+    start times. When the quota of a user is used up, its requests wait
+    until enough of its past usage leaves the window.
+
+    The ledgers are private to the process. A ledger is dropped when its
+    usage drops to zero.
+    """
+
+    __slots__ = (
+        "window",
+        "ledgers",
+        "running",
+        "last_capacity",
+        "last_value",
+        "clock",
+    )
+
+    name = "quota"
+
+    refills = True
+
+    def __init__(self, environment, info, condition, conclusion, window=None):
+        super().__init__(environment, info, condition, conclusion)
+        self.window = window
+        self.clock = time.time
+        self.reset()
+
+    def reset(self):
+        self.ledgers = {}
+        # The number of running requests of each user, and the sum of their
+        # start times
+        self.running = {}
+        self.last_capacity = None
+        self.last_value = 0
+
+    def inherit(self, rule):
+        """Take over the ledgers of 'rule', the same rule in a previous rule set.
+        The running requests are registered again, see QoS.reconfigure()."""
+        self.ledgers = rule.ledgers
+
+    @property
+    def value(self):
+        """The usage of the last user checked"""
+        return self.last_value
+
+    def capacity(self, request):
+        return self.evaluate(request)
+
+    def _window(self, request):
+        if self.window is None:
+            return 24 * 60 * 60
+        return self.window.evaluate(Context(request, self.environment))
+
+    def amount(self, request):
+        return 0
+
+    def increment(self, amount=0):
+        pass
+
+    def decrement(self, amount=0):
+        pass
+
+    def start(self, request, start):
+        """Record that a request started at 'start'"""
+        running = self.running.setdefault(request.user, [0, 0.0])
+        running[0] += 1
+        running[1] += start
+
+    def charge(self, request, start, end):
+        """Record the run time of a request that ran between 'start' and 'end'"""
+        running = self.running.get(request.user)
+        if running is not None:
+            running[0] -= 1
+            running[1] -= start
+            if running[0] <= 0:
+                del self.running[request.user]
+
+        ledger = self.ledgers.get(request.user)
+        if ledger is None:
+            ledger = self.ledgers[request.user] = Ledger(self._window(request))
+        ledger.add(start, end)
+
+    def _elapsed(self, user, now):
+        """Returns the time elapsed since the start of the running requests of
+        'user', in total"""
+        running = self.running.get(user)
+        if running is None:
+            return 0
+        return max(0, running[0] * now - running[1])
+
+    def full(self, request, value=None):
+        self.last_capacity = self.capacity(request)
+        if value is None:
+            now = self.clock()
+            ledger = self.ledgers.get(request.user)
+            value = 0 if ledger is None else ledger.usage(now)
+            if ledger is not None and value == 0:
+                del self.ledgers[request.user]
+            value += self._elapsed(request.user, now)
+        self.last_value = value
+        return value >= self.last_capacity
+
+    def next_refill(self, request):
+        """Returns the time at which the user of 'request' is below its quota,
+        if its running requests ended now. Until they end, their usage grows, so
+        the quota is checked again at that time."""
+        ledger = self.ledgers.get(request.user)
+        if ledger is None:
+            return None
+        now = self.clock()
+        capacity = self.capacity(request) - self._elapsed(request.user, now)
+        return ledger.below(capacity, now)
+
+    def options(self):
+        return dict(window=self.window)
+
+
 class RuleSet:
     """
     This utility class is used to store all rules in a single neat an
@@ -151,6 +526,11 @@ class RuleSet:
         self.global_limits = []
         self.permissions = []
         self.user_limits = []
+        self.retries = []
+        self.queue_limits = []
+        self.shares = []
+        self.rates = []
+        self.quotas = []
 
     def add_priority(self, environment, info, condition, conclusion):
         self.priorities.append(Priority(environment, info, condition, conclusion))
@@ -158,11 +538,32 @@ class RuleSet:
     def add_permission(self, environment, info, condition, conclusion):
         self.permissions.append(Permission(environment, info, condition, conclusion))
 
-    def add_user_limit(self, environment, info, condition, conclusion):
-        self.user_limits.append(UserLimit(environment, info, condition, conclusion))
+    def add_user_limit(self, environment, info, condition, conclusion, weight=None):
+        self.user_limits.append(
+            UserLimit(environment, info, condition, conclusion, weight)
+        )
 
-    def add_global_limit(self, environment, info, condition, conclusion):
-        self.global_limits.append(GlobalLimit(environment, info, condition, conclusion))
+    def add_global_limit(
+        self, environment, info, condition, conclusion, weight=None, per=None
+    ):
+        self.global_limits.append(
+            GlobalLimit(environment, info, condition, conclusion, weight, per)
+        )
+
+    def add_retry(self, environment, info, condition, conclusion):
+        self.retries.append(Retry(environment, info, condition, conclusion))
+
+    def add_queue_limit(self, environment, info, condition, conclusion):
+        self.queue_limits.append(QueueLimit(environment, info, condition, conclusion))
+
+    def add_rate(self, environment, info, condition, conclusion, burst=None):
+        self.rates.append(RateLimit(environment, info, condition, conclusion, burst))
+
+    def add_quota(self, environment, info, condition, conclusion, window=None):
+        self.quotas.append(QuotaLimit(environment, info, condition, conclusion, window))
+
+    def add_share(self, environment, info, condition, conclusion):
+        self.shares.append(Share(environment, info, condition, conclusion))
 
     def dump(self, out=print):
         out()
@@ -188,3 +589,33 @@ class RuleSet:
         out()
         for p in self.priorities:
             p.dump(out)
+
+        out()
+        out("# Retries:")
+        out()
+        for p in self.retries:
+            p.dump(out)
+
+        out()
+        out("# Queue limits:")
+        out()
+        for p in self.queue_limits:
+            p.dump(out)
+
+        out()
+        out("# Rates:")
+        out()
+        for p in self.rates:
+            p.dump(out)
+
+        out()
+        out("# Quotas:")
+        out()
+        for p in self.quotas:
+            p.dump(out)
+
+        out()
+        out("# Shares:")
+        out()
+        for p in self.shares:
+            p.dump(out)
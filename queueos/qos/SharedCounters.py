@@ -0,0 +1,270 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = 0x514F5343  # 'QOSC'
+
+# Marks an entry of the key table whose counter was freed
+DELETED = -1
+
+
+class SharedCountersError(Exception):
+    pass
+
+
+class SharedCounter:
+    """A counter stored in a SharedCounters segment. Its value is the sum of
+    the contributions of all the live processes attached to the segment."""
+
+    def __init__(self, backend, index):
+        self.backend = backend
+        self.index = index
+
+    @property
+    def value(self):
+        return self.backend.value(self.index)
+
+    def add(self, amount):
+        self.backend.add(self.index, amount)
+
+
+class SharedCounters:
+    """This class is a counter backend for limits, that allows several broker
+    processes on the same host to share the values of their limits. The
+    counters live in a 'multiprocessing.shared_memory' segment called 'name'.
+
+    Each attached process owns a 'slot', and only ever writes its own
+    contribution to each counter, so increments and decrements need no
+    inter-process lock: a counter's value is the sum of the contributions
+    of all the slots. The slot is leased to the process id that owns it.
+    When a process dies without detaching, its slot is reclaimed (and its
+    contributions dropped) by the next process that checks the leases, which
+    happens at most every 'lease_check' seconds.
+
+    Each slot also flags the counters its process references. A counter is
+    freed, so that its entry can be reused by another key, once no process
+    references it and its value is zero, see release(). Per-user and keyed
+    limits are released when the QoS evicts them.
+
+    Allocating a slot or a new counter takes an exclusive lock on a file
+    next to the segment. Such locks are released by the kernel if their
+    owner crashes.
+
+    NOTE: checking that a limit is not full and incrementing it are two
+    separate operations, so two processes may both start a request when
+    only one slot is left. Limits may therefore be exceeded by at most one
+    request per process for a brief time.
+    """
+
+    def __init__(self, name, counters=4096, slots=64, lock_path=None, lease_check=1):
+        self.name = name
+        self.counters = counters
+        self.slots = slots
+        self.lease_check = lease_check
+        self.last_lease_check = 0
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+        if lock_path is None:
+            lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self.lock_file = open(lock_path, "a+")
+
+        # Header: magic, counters, slots; then the key table, the table
+        # of the pids owning the slots, the values and the references
+        size = 8 * (3 + counters + slots + counters * slots) + counters * slots
+
+        with self._exclusive():
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name)
+            # The segment must outlive this process, see unlink()
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+            self.header = self.shm.buf[0:24].cast("q")
+            if self.header[0] == 0:
+                self.header[0] = MAGIC
+                self.header[1] = counters
+                self.header[2] = slots
+            if tuple(self.header) != (MAGIC, counters, slots):
+                raise SharedCountersError(
+                    f"Shared memory '{name}' has an incompatible layout"
+                )
+
+            offset = 24
+            self.keys = self.shm.buf[offset : offset + 8 * counters].cast("q")
+            offset += 8 * counters
+            self.pids = self.shm.buf[offset : offset + 8 * slots].cast("q")
+            offset += 8 * slots
+            self.values = self.shm.buf[offset : offset + 8 * counters * slots].cast("d")
+            offset += 8 * counters * slots
+            self.refs = self.shm.buf[offset : offset + counters * slots]
+
+            self._reclaim()
+            self.slot = self._allocate_slot()
+
+    @contextmanager
+    def _exclusive(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _allocate_slot(self):
+        for slot in range(self.slots):
+            if self.pids[slot] == 0:
+                self.pids[slot] = os.getpid()
+                return slot
+        raise SharedCountersError(f"No free slot in shared memory '{self.name}'")
+
+    def _reclaim(self):
+        """Drop the contributions of the processes that died. Must be called with
+        the file lock held."""
+        for slot in range(self.slots):
+            pid = self.pids[slot]
+            if pid != 0 and not alive(pid):
+                self._drop(slot)
+                self.pids[slot] = 0
+
+    def _drop(self, slot):
+        """Drop the contributions and references of 'slot', and free the counters
+        that are no longer used. Must be called with the file lock held."""
+        for index in range(self.counters):
+            cell = index * self.slots + slot
+            self.values[cell] = 0
+            if self.refs[cell]:
+                self.refs[cell] = 0
+                self._free(index)
+
+    def _free(self, index):
+        """Free the counter at 'index' if no process uses it. Must be called with
+        the file lock held."""
+        base = index * self.slots
+        if any(self.refs[base : base + self.slots]):
+            return
+        if any(self.values[base : base + self.slots]):
+            return
+        self.keys[index] = DELETED
+
+    def _check_leases(self):
+        now = time.time()
+        if now - self.last_lease_check < self.lease_check:
+            return
+        self.last_lease_check = now
+        with self._exclusive():
+            self._reclaim()
+
+    def counter(self, key):
+        """Returns the counter associated with 'key', creating it if needed"""
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = self._index(key)
+                self.indexes[key] = index
+        return SharedCounter(self, index)
+
+    def _index(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        h = int.from_bytes(digest, "little", signed=True)
+        if h in (0, DELETED):
+            # Zero marks an empty entry
+            h = 1
+        with self._exclusive():
+            index = self._lookup(h)
+            self.refs[index * self.slots + self.slot] = 1
+            return index
+
+    def _lookup(self, h):
+        # Open addressing with linear probing. Freed entries are reused, but
+        # do not end the probe, as the key may be further
+        start = h % self.counters
+        free = None
+        for i in range(self.counters):
+            index = (start + i) % self.counters
+            if self.keys[index] == h:
+                return index
+            if self.keys[index] == DELETED and free is None:
+                free = index
+            if self.keys[index] == 0:
+                if free is None:
+                    free = index
+                break
+        if free is None:
+            raise SharedCountersError(f"No free counter in shared memory '{self.name}'")
+        self.keys[free] = h
+        return free
+
+    def release(self, key):
+        """Drop the reference of this process to the counter associated with
+        'key', whose contribution must be zero. The counter is freed when no
+        process references it anymore."""
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is None:
+                return
+            with self._exclusive():
+                cell = index * self.slots + self.slot
+                self.values[cell] = 0
+                self.refs[cell] = 0
+                self._free(index)
+
+    def value(self, index):
+        self._check_leases()
+        base = index * self.slots
+        return sum(self.values[base : base + self.slots])
+
+    def add(self, index, amount):
+        """Add 'amount' to the contribution of this process. The contribution
+        never goes below zero."""
+        with self.lock:
+            cell = index * self.slots + self.slot
+            self.values[cell] = max(0, self.values[cell] + amount)
+
+    def reset(self):
+        """Set all the contributions of this process to zero, and release all its
+        counters"""
+        with self.lock:
+            self.indexes.clear()
+            with self._exclusive():
+                self._drop(self.slot)
+
+    def close(self):
+        """Release the slot of this process and detach from the segment"""
+        with self.lock:
+            self.indexes.clear()
+            with self._exclusive():
+                self._drop(self.slot)
+                self.pids[self.slot] = 0
+        for view in (self.header, self.keys, self.pids, self.values, self.refs):
+            view.release()
+        self.shm.close()
+        self.lock_file.close()
+
+    def unlink(self):
+        """Destroy the segment, once no process uses it anymore"""
+        shared_memory.SharedMemory(self.name).unlink()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,155 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import argparse
+import io
+import random
+import time
+
+from queueos import Environment
+from queueos.dispatcher.Simulator import SimulatedRequest, Simulator, distribution
+from queueos.expressions.RulesParser import RulesParser
+from queueos.qos.FairShareQoS import FairShareQoS
+from queueos.qos.QoS import QoS
+from queueos.qos.Rule import RuleSet
+
+# This benchmark compares the priority policy of the QoS with the weighted
+# fair queuing of the FairShareQoS, by simulating the same workload with
+# both. A few heavy users submit bursts of requests, while many light users
+# submit requests at a steady rate. For each policy, it prints:
+#
+#   makespan    time at which the last request ended
+#   throughput  requests completed per simulated hour
+#   heavy/light mean and p99 wait, and mean slowdown of the requests of
+#               each kind of user, where the slowdown of a request is
+#               (wait + duration) / duration
+#   time        real time taken by the simulation
+#
+# The throughput should be the same with both policies, as they keep the
+# workers busy. With a fair share, the light users should barely notice
+# the bursts of the heavy users, which wait longer instead.
+
+
+RULES = """
+user "Default per-user limit" (user ~ ".*") : {per_user}
+"""
+
+
+def parse_rules(text, environment):
+    rules = RuleSet()
+    RulesParser(io.StringIO(text)).parse_rules(rules, environment)
+    return rules
+
+
+def workload(args, seed=0):
+    rng = random.Random(seed)
+    requests = []
+    for i in range(args.heavy):
+        # Bursts at random times during the first half of the period
+        for _ in range(args.bursts):
+            start = rng.uniform(0, args.period / 2)
+            for _ in range(args.burst_size):
+                requests.append(
+                    (start, rng.expovariate(1 / args.duration), f"heavy-{i}")
+                )
+
+    for i in range(args.light):
+        start = rng.expovariate(args.rate)
+        while start < args.period:
+            requests.append((start, rng.expovariate(1 / args.duration), f"light-{i}"))
+            start += rng.expovariate(args.rate)
+
+    requests.sort()
+    return [SimulatedRequest(*r) for r in requests]
+
+
+class Slowdowns:
+    """Records the slowdown of the requests of each user, as a listener of
+    the Simulator"""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.users = {}
+
+    def notify_enqueue_of_request(self, request):
+        pass
+
+    def notify_start_of_request(self, request):
+        wait = request.age_at(self.simulator.now)
+        duration = max(request.duration, 1e-3)
+        self.users.setdefault(request.user, []).append((wait + duration) / duration)
+
+    def notify_end_of_request(self, request):
+        pass
+
+
+def measure(args, qos_class):
+    environment = Environment()
+    rules = parse_rules(RULES.format(per_user=args.per_user), environment)
+    simulator = Simulator(rules, args.workers, environment, qos_class=qos_class)
+    slowdowns = Slowdowns(simulator)
+    simulator.add_listener(slowdowns)
+
+    requests = workload(args)
+    start = time.perf_counter()
+    makespan = simulator.run(requests)
+    elapsed = time.perf_counter() - start
+
+    result = dict(
+        makespan=makespan,
+        throughput=simulator.completed / makespan * 3600,
+    )
+    for kind in ("heavy", "light"):
+        waits = [
+            wait
+            for user, values in simulator.user_waits.items()
+            if user.startswith(kind)
+            for wait in values
+        ]
+        stats = distribution(waits)
+        result[f"{kind} mean"] = stats["mean"]
+        result[f"{kind} p99"] = stats["p99"]
+        values = [
+            value
+            for user, values in slowdowns.users.items()
+            if user.startswith(kind)
+            for value in values
+        ]
+        result[f"{kind} slowdown"] = sum(values) / len(values)
+    result["time"] = elapsed
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fair share and priorities")
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--per-user", type=int, default=10)
+    parser.add_argument("--heavy", type=int, default=2, help="number of heavy users")
+    parser.add_argument("--bursts", type=int, default=3)
+    parser.add_argument("--burst-size", type=int, default=500)
+    parser.add_argument("--light", type=int, default=50, help="number of light users")
+    parser.add_argument(
+        "--rate", type=float, default=1 / 600, help="requests/s per light user"
+    )
+    parser.add_argument("--duration", type=float, default=60, help="mean duration")
+    parser.add_argument("--period", type=float, default=6 * 3600)
+    args = parser.parse_args()
+
+    results = {}
+    for name, qos_class in (("priority", QoS), ("fair share", FairShareQoS)):
+        results[name] = measure(args, qos_class)
+
+    names = list(results)
+    print(f"{'':16}" + "".join(f"{name:>14}" for name in names))
+    for key in results[names[0]]:
+        print(f"{key:16}" + "".join(f"{results[name][key]:14.2f}" for name in names))
+
+
+if __name__ == "__main__":
+    main()
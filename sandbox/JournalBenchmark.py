@@ -0,0 +1,59 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import os
+import tempfile
+import time
+
+from queueos import Broker, Environment, Journal, Request
+from queueos.qos.Rule import RuleSet
+
+# This benchmark compares the enqueue throughput of a broker with and
+# without a journal. The broker is paused, so only enqueuing is measured.
+# For the journal, the time includes flushing all the events to disk.
+
+COUNT = 20000
+
+
+class BenchmarkRequest(Request):
+    def __init__(self, user):
+        super().__init__()
+        self.user = user
+        self.dataset = "dataset-1"
+        self.cost = (0, 0)
+
+
+def run(journal):
+    broker = Broker(RuleSet(), 0, Environment(), journal=journal)
+    broker.pause()
+    requests = [BenchmarkRequest(f"user-{i % 100}") for i in range(COUNT)]
+
+    start = time.time()
+    for r in requests:
+        broker.enqueue(r)
+    if journal is not None:
+        journal.flush()
+    elapsed = time.time() - start
+
+    if journal is not None:
+        journal.close()
+    return COUNT / elapsed
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    memory = run(None)
+    journaled = run(Journal(os.path.join(tmp, "journal.db")))
+
+    print(f"in-memory enqueue: {memory:10.0f} requests/s")
+    print(f"journaled enqueue: {journaled:10.0f} requests/s")
+
+    start = time.time()
+    count = len(Journal(os.path.join(tmp, "journal.db")).replay())
+    elapsed = time.time() - start
+    print(f"replay:            {count / elapsed:10.0f} requests/s ({count} requests)")
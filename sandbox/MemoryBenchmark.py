@@ -0,0 +1,82 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import gc
+import os
+import random
+import tracemalloc
+
+from queueos import Broker, Environment, FunctionFactory, Request
+
+# This benchmark reports the memory used per queued request, including the
+# Properties computed by the QoS, using the rules in 'broker.rules'. It is
+# measured with and without the futures returned by Broker.enqueue_many(),
+# which are only created when asked for.
+
+COUNT = 100000
+
+USERS = [f"user-{i}" for i in range(100)]
+DATASETS = ["dataset-1", "dataset-2", "dataset-3"]
+ADAPTORS = ["adaptor1", "adaptor2"]
+
+FunctionFactory.register_function(
+    "dataset",
+    lambda context, *args: context.request.dataset,
+)
+FunctionFactory.register_function(
+    "adaptor",
+    lambda context, *args: context.request.adaptor,
+)
+
+
+class BenchmarkRequest(Request):
+    def __init__(self, user, dataset, adaptor):
+        super().__init__()
+        self.user = user
+        self.dataset = dataset
+        self.adaptor = adaptor
+        self.cost = (0, 0)
+
+
+random.seed(0)
+attributes = [
+    (random.choice(USERS), random.choice(DATASETS), random.choice(ADAPTORS))
+    for _ in range(COUNT)
+]
+
+
+def measure(futures):
+    broker = Broker(
+        os.path.join(os.path.dirname(__file__), "broker.rules"),
+        0,
+        Environment(),
+    )
+    broker.pause()
+    requests = (BenchmarkRequest(*a) for a in attributes)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    if futures:
+        result = broker.enqueue_many(requests)
+    else:
+        result = broker.dispatcher.enqueue_many(requests)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+print(f"{COUNT} queued requests:")
+print(f"    without futures: {measure(False) / COUNT:6.0f} bytes per request")
+print(f"    with futures:    {measure(True) / COUNT:6.0f} bytes per request")
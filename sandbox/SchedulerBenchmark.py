@@ -0,0 +1,198 @@
+# (C) Copyright 2021 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import argparse
+import gc
+import io
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+from queueos import Broker, Environment, FunctionFactory, Request
+from queueos.expressions.RulesParser import RulesParser
+from queueos.qos.QoS import QoS
+from queueos.qos.Rule import RuleSet
+
+# This benchmark measures the hot paths of the scheduler on synthetic
+# workloads, for every combination of the parameters given on the command
+# line (see --help):
+#
+#   parse     rules parsed per second by the RulesParser
+#   prepare   requests per second through QoS._properties()
+#   enqueue   requests per second through Broker.enqueue(), broker paused
+#   pick      picks per second and p99 latency of QoS.pick() at a constant
+#             queue depth, without threads
+#   run       requests per second completed by the workers, end to end
+#   memory    bytes per queued request, including its Properties
+#
+# Users and datasets are drawn from a Zipf-like distribution, so that a few
+# of them receive most of the requests when --skew is above zero. Use
+# --output to save the results as JSON and compare them between commits.
+
+FunctionFactory.register_function(
+    "dataset",
+    lambda context, *args: context.request.dataset,
+)
+
+
+class BenchmarkRequest(Request):
+    def __init__(self, user, dataset, duration):
+        super().__init__()
+        self.user = user
+        self.dataset = dataset
+        self.duration = duration
+        self.cost = (0, 0)
+
+    def execute(self):
+        if self.duration:
+            time.sleep(self.duration)
+
+
+def rules_text(count, users, datasets):
+    """Returns 'count' rules: a default per-user limit, then limits on
+    datasets and priorities of users, in turn"""
+    lines = ['user "Default per-user limit" (user ~ ".*") : 10']
+    for i in range(count - 1):
+        if i % 2 == 0:
+            dataset = datasets[(i // 2) % len(datasets)]
+            lines.append(f'limit "Limit {i}" (dataset == "{dataset}") : {5 + i % 7}')
+        else:
+            user = users[(i // 2) % len(users)]
+            lines.append(f'priority "Priority {i}" (user == "{user}") : {i * 60}')
+    return "\n".join(lines) + "\n"
+
+
+def parse_rules(text, environment):
+    rules = RuleSet()
+    RulesParser(io.StringIO(text)).parse_rules(rules, environment)
+    return rules
+
+
+def zipf(names, skew, rng):
+    """Returns a function drawing names, the first ones being favoured when
+    'skew' is above zero"""
+    weights = list(itertools.accumulate(1 / (i + 1) ** skew for i in range(len(names))))
+    return lambda: rng.choices(names, cum_weights=weights)[0]
+
+
+def workload(count, users, datasets, skew, duration, seed=0):
+    rng = random.Random(seed)
+    user = zipf(users, skew, rng)
+    dataset = zipf(datasets, skew, rng)
+    return [BenchmarkRequest(user(), dataset(), duration) for _ in range(count)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(args, depth, rules, skew, workers, duration):
+    users = [f"user-{i}" for i in range(args.users)]
+    datasets = [f"dataset-{i}" for i in range(args.datasets)]
+    environment = Environment()
+    text = rules_text(rules, users, datasets)
+    result = {}
+
+    start = time.perf_counter()
+    for _ in range(10):
+        parse_rules(text, environment)
+    result["parse/s"] = 10 * rules / (time.perf_counter() - start)
+
+    qos = QoS(parse_rules(text, environment), environment)
+    requests = workload(args.count, users, datasets, skew, 0)
+    start = time.perf_counter()
+    qos.prepare(requests)
+    result["prepare/s"] = len(requests) / (time.perf_counter() - start)
+
+    broker = Broker(parse_rules(text, environment), 0, environment)
+    broker.pause()
+    requests = workload(args.count, users, datasets, skew, 0)
+    start = time.perf_counter()
+    for request in requests:
+        broker.enqueue(request)
+    result["enqueue/s"] = len(requests) / (time.perf_counter() - start)
+
+    # Keep the queue at the same depth: each picked request ends at once
+    # and is replaced by a new one
+    qos = QoS(parse_rules(text, environment), environment)
+    queue = workload(depth, users, datasets, skew, 0)
+    fresh = iter(workload(args.picks, users, datasets, skew, 0, seed=1))
+    latencies = []
+    for _ in range(args.picks):
+        start = time.perf_counter()
+        request = qos.pick(queue)
+        latencies.append(time.perf_counter() - start)
+        qos.notify_start_of_request(request)
+        qos.notify_end_of_request(request)
+        queue.append(next(fresh))
+    result["pick/s"] = len(latencies) / sum(latencies)
+    result["pick p99 (us)"] = percentile(latencies, 99) * 1e6
+
+    broker = Broker(parse_rules(text, environment), workers, environment)
+    requests = workload(args.count, users, datasets, skew, duration)
+    start = time.perf_counter()
+    broker.enqueue_many(requests)
+    broker.wait_for_all_requests()
+    result["run/s"] = len(requests) / (time.perf_counter() - start)
+    broker.shutdown()
+
+    broker = Broker(parse_rules(text, environment), 0, environment)
+    broker.pause()
+    requests = workload(args.count, users, datasets, skew, 0)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    broker.dispatcher.enqueue_many(requests)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    result["bytes/request"] = size / len(requests)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler")
+    parser.add_argument("--depth", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--skew", type=float, nargs="+", default=[0, 1.5])
+    parser.add_argument("--workers", type=int, nargs="+", default=[4])
+    parser.add_argument("--duration", type=float, nargs="+", default=[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--datasets", type=int, default=10)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--picks", type=int, default=500)
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for depth, rules, skew, workers, duration in itertools.product(
+        args.depth, args.rules, args.skew, args.workers, args.duration
+    ):
+        parameters = dict(
+            depth=depth, rules=rules, skew=skew, workers=workers, duration=duration
+        )
+        result = measure(args, **parameters)
+        results.append(dict(parameters=parameters, result=result))
+
+        print(", ".join(f"{k}={v}" for k, v in parameters.items()))
+        for k, v in result.items():
+            print(f"    {k:16} {v:12.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,28 @@
+import asyncio
 import io
+import threading
 import time
 
-from queueos import Broker, Environment, FunctionFactory, Request, Status
+from queueos import (
+    Admission,
+    AsyncBroker,
+    Broker,
+    Environment,
+    FunctionFactory,
+    Journal,
+    QueueFull,
+    Recorder,
+    Request,
+    RequestCanceled,
+    Status,
+    Tracer,
+)
+from queueos.broker import Tracer as tracing
+from queueos.broker.Replayer import Replayer
+from queueos.dispatcher.Admission import BLOCK, SHED
+from queueos.dispatcher.Autoscaler import Autoscaler
+from queueos.dispatcher.RetryPolicy import RetryPolicy
+from queueos.dispatcher.ShardedQueue import ShardedQueue
 from queueos.expressions.RulesParser import RulesParser
 from queueos.qos.Rule import RuleSet
 
@@ -28,6 +49,7 @@ class SimpleRequest(Request):
     def execute(self):
         time.sleep(0.01)
         self.time = time.time()
+        return self.user
 
 
 environment = Environment()
@@ -101,5 +123,535 @@ def test_global_limits():
     assert a.time > c.time
 
 
+class FailingRequest(SimpleRequest):
+    def execute(self):
+        raise ValueError(self.user)
+
+
+def test_futures():
+    broker = Broker(RULES1, 1, environment)
+    broker.pause()
+    a = broker.enqueue(SimpleRequest("erin"))
+    b = broker.enqueue(FailingRequest("frank"))
+    c = SimpleRequest("david")
+    broker.enqueue(c)
+    done = []
+    c.add_done_callback(done.append)
+    d = SimpleRequest("erin")
+    broker.enqueue(d)
+    assert d.future.cancel()
+    broker.resume()
+
+    assert a.result(10) == "erin"
+    assert isinstance(b.exception(10), ValueError)
+    assert c.result(10) == "david"
+    assert done == [c]
+    assert d.status == Status.ABORTED
+    assert isinstance(d.error, RequestCanceled)
+
+    broker.shutdown()
+
+
+def test_not_before():
+    broker = Broker(RULES1, 1, environment)
+    not_before = time.time() + 0.3
+    a = SimpleRequest("erin")
+    broker.enqueue(a, not_before=not_before)
+    assert a.status == Status.DELAYED
+    b = SimpleRequest("erin")
+    broker.enqueue(b)
+    broker.shutdown()
+
+    assert a.status == Status.COMPLETE
+    assert b.status == Status.COMPLETE
+    assert b.time < not_before <= a.time
+
+
+def test_not_before_under_load():
+    broker = Broker(RULES1, 1, environment)
+    busy = broker.enqueue_many(SimpleRequest("erin") for _ in range(100))
+    not_before = time.time() + 0.1
+    a = SimpleRequest("david")
+    broker.enqueue(a, not_before=not_before)
+
+    # Poll the request, the queue is still busy when it runs
+    assert a.result(10) == "david"
+    assert a.time - not_before < 0.5
+    assert not all(f.done() for f in busy)
+    broker.shutdown()
+
+
+class FlakyRequest(SimpleRequest):
+    def __init__(self, user, failures):
+        super().__init__(user)
+        self.failures = failures
+
+    def execute(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ValueError(self.failures)
+        return super().execute()
+
+
+RULES_RETRY = compile(
+    """
+retry "Retry erin"    (user == "erin") : 2
+"""
+)
+
+
+def test_retries():
+    broker = Broker(RULES_RETRY, 1, environment)
+    broker.qos.retry_policy = RetryPolicy(delay=0.01)
+    a = FlakyRequest("erin", 2)
+    start = a.start
+    b = FlakyRequest("erin", 3)
+    c = FlakyRequest("frank", 1)
+    d = FlakyRequest("frank", 1)
+    d.retry_policy = RetryPolicy(max_retries=1, delay=0.01)
+    for r in (a, b, c, d):
+        broker.enqueue(r)
+
+    assert a.result(10) == "erin"
+    assert a.attempts == 2
+    assert a.start == start
+    assert isinstance(b.future.exception(10), ValueError)
+    assert b.attempts == 2
+    assert isinstance(c.future.exception(10), ValueError)
+    assert c.attempts == 0
+    assert d.result(10) == "frank"
+    broker.shutdown()
+    assert b.status == Status.ABORTED
+
+
+def test_retries_under_load():
+    broker = Broker(RULES_RETRY, 1, environment)
+    broker.qos.retry_policy = RetryPolicy(delay=0.05, jitter=0)
+    a = FlakyRequest("erin", 1)
+    broker.enqueue(a)
+    failed = time.time()
+    busy = broker.enqueue_many(SimpleRequest("frank") for _ in range(100))
+
+    # The retry is queued when its backoff expires, while the queue is busy
+    assert a.result(10) == "erin"
+    assert a.attempts == 1
+    assert a.time - failed < 0.5
+    assert not all(f.done() for f in busy)
+    broker.shutdown()
+
+
+def test_journal(tmp_path):
+    path = str(tmp_path / "journal.db")
+
+    journal = Journal(path)
+    broker = Broker(RULES1, 1, Environment(), journal=journal)
+    broker.pause()
+    requests = [SimpleRequest(user) for user in ("erin", "frank", "david")]
+    for r in requests:
+        broker.enqueue(r)
+    journal.flush()
+    # Simulate a crash
+    journal.close()
+    broker.dispatcher.listeners.clear()
+
+    journal = Journal(path)
+    broker = Broker(RULES1, 1, Environment(), journal=journal)
+    assert broker.known_requests == 3
+    reloaded = list(broker.dispatcher.known_requests)
+    assert [(r.id, r.start) for r in reloaded] == [(r.id, r.start) for r in requests]
+    assert SimpleRequest("erin").id > max(r.id for r in requests)
+
+    for r in reloaded:
+        assert r.result(10) == r.user
+    broker.shutdown()
+    journal.close()
+
+    assert Journal(path).replay() == []
+
+
+def test_enqueue_many():
+    broker = Broker(RULES1, 2, environment)
+    broker.pause()
+    requests = [SimpleRequest(user) for user in ("erin", "frank", "david") * 10]
+    futures = broker.enqueue_many(requests)
+    assert broker.known_requests == 30
+    assert all(r.status == Status.QUEUED for r in requests)
+    assert all(r in broker.qos.requests_properties_cache for r in requests)
+    broker.resume()
+    assert [f.result(10) for f in futures] == [r.user for r in requests]
+    broker.shutdown()
+
+
+RULES_WORKERS = compile(
+    """
+priority "scale" match(user(),".*") : mul(numberOfWorkers(),10)
+"""
+)
+
+
+def test_rules_using_the_dispatcher():
+    broker = Broker(RULES_WORKERS, 3, environment)
+    broker.pause()
+    a = SimpleRequest("erin")
+    b = SimpleRequest("erin")
+    broker.enqueue(a)
+    broker.enqueue_many([b])
+    for request in (a, b):
+        assert broker.qos.requests_properties_cache[request].starting_priority == 30
+    broker.resume()
+    assert a.result(10) == b.result(10) == "erin"
+    broker.shutdown()
+
+
+RULES_SHARDS = compile(
+    """
+limit "Limit for adaptor1"    (adaptor == "adaptor1") : 2
+"""
+)
+
+
+class CountingRequest(SimpleRequest):
+    running = 0
+    highest = 0
+    lock = threading.Lock()
+
+    def execute(self):
+        cls = CountingRequest
+        with cls.lock:
+            cls.running += 1
+            cls.highest = max(cls.highest, cls.running)
+        time.sleep(0.005)
+        with cls.lock:
+            cls.running -= 1
+        return self.user
+
+
+def test_sharded_queue():
+    broker = Broker(RULES_SHARDS, 8, environment, queue=ShardedQueue(4))
+    broker.pause()
+    users = ["alice", "bob", "carlos", "david", "erin", "frank"]
+    requests = [CountingRequest(users[i % len(users)]) for i in range(60)]
+    futures = broker.enqueue_many(requests)
+    assert len(broker.dispatcher.queue) == 60
+    broker.resume()
+
+    assert [f.result(10) for f in futures] == [r.user for r in requests]
+    assert CountingRequest.highest == 2
+    broker.shutdown()
+
+
+def test_sharded_queue_priorities():
+    shards = ["erin", "frank", "david"]
+    queue = ShardedQueue(4, key=lambda request: shards.index(request.user))
+    broker = Broker(RULES1, 1, environment, queue=queue)
+    broker.pause()
+    users = ["erin"] * 5 + ["frank"] * 5 + ["david"]
+    requests = [SimpleRequest(user) for user in users]
+    broker.enqueue_many(requests)
+    broker.resume()
+    broker.wait_for_all_requests()
+
+    # The worker's home shard is the one of erin, whose requests have the
+    # lowest priority, so the others are stolen first
+    order = [r.user for r in sorted(requests, key=lambda r: r.time)]
+    assert order == ["david"] + ["frank"] * 5 + ["erin"] * 5
+    broker.shutdown()
+
+
+RULES3 = compile(
+    """
+limit "No frank"    (user == "frank") : 0
+"""
+)
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_autoscaler():
+    autoscaler = Autoscaler(min_workers=0, max_workers=4, idle_timeout=0.2)
+    broker = Broker(RULES3, 0, Environment(), autoscaler)
+
+    blocked = SimpleRequest("frank")
+    broker.enqueue(blocked)
+    assert broker.dispatcher.number_of_workers == 0
+    assert autoscaler.metrics()["blocked"] == 1
+
+    # Each enqueue only checks the new request, not the blocked ones
+    calls = []
+    can_run = broker.qos.can_run
+    broker.qos.can_run = lambda request: calls.append(request) or can_run(request)
+    for _ in range(100):
+        broker.enqueue(SimpleRequest("frank"))
+    assert len(calls) == 100
+    assert broker.dispatcher.number_of_workers == 0
+    del broker.qos.can_run
+
+    futures = [broker.enqueue(SimpleRequest("erin")) for _ in range(10)]
+    assert broker.dispatcher.number_of_workers == 4
+    for f in futures:
+        f.result(10)
+
+    wait_until(lambda: broker.dispatcher.number_of_workers == 0)
+    assert autoscaler.metrics()["scale_downs"] == 4
+    assert blocked.status == Status.QUEUED
+
+    # Pin the pool size, the stop markers are not mistaken for idle workers
+    broker.set_number_of_workers(2)
+    assert (autoscaler.min_workers, autoscaler.max_workers) == (2, 2)
+    assert broker.dispatcher.number_of_workers == 2
+    broker.set_number_of_workers(0)
+    wait_until(lambda: broker.dispatcher.number_of_idle_workers == 0)
+    assert broker.dispatcher.number_of_workers == 0
+
+
+class AsyncRequest(SimpleRequest):
+    async def execute(self):
+        await asyncio.sleep(0.01)
+        self.time = time.time()
+        return self.user
+
+
+def test_async_priorities():
+    async def run():
+        broker = AsyncBroker(RULES1, 1, environment)
+        broker.start()
+        broker.pause()
+        a = AsyncRequest("erin")
+        broker.enqueue(a)
+        c = AsyncRequest("frank")
+        broker.enqueue(c)
+        b = AsyncRequest("david")
+        broker.enqueue(b)
+        broker.resume()
+        await broker.shutdown()
+        return a, b, c
+
+    a, b, c = asyncio.run(run())
+
+    assert a.status == Status.COMPLETE
+    assert b.status == Status.COMPLETE
+    assert c.status == Status.COMPLETE
+
+    assert a.time > b.time
+    assert c.time > b.time
+    assert a.time > c.time
+
+
+class CancelledRequest(SimpleRequest):
+    async def execute(self):
+        raise asyncio.CancelledError()
+
+
+def test_async_cancelled():
+    async def run():
+        broker = AsyncBroker(RULES1, 1, environment)
+        broker.start()
+        request = CancelledRequest("erin")
+        future = broker.enqueue(request)
+        try:
+            await future
+        except asyncio.CancelledError:
+            pass
+        await broker.shutdown()
+        return broker, request
+
+    broker, request = asyncio.run(run())
+
+    assert request.status == Status.ABORTED
+    assert broker.dispatcher.number_of_active_requests == 0
+    assert broker.known_requests == 0
+
+
+def test_async_concurrency():
+    async def run():
+        broker = AsyncBroker(RULES1, 1000, environment)
+        broker.start()
+        requests = [AsyncRequest("erin") for _ in range(1000)]
+        futures = [broker.enqueue(r) for r in requests]
+        assert await asyncio.gather(*futures) == ["erin"] * 1000
+        await broker.shutdown()
+        return requests
+
+    start = time.time()
+    requests = asyncio.run(run())
+
+    assert all(r.status == Status.COMPLETE for r in requests)
+    # Run concurrently, not one after the other
+    assert time.time() - start < 5
+
+
 if __name__ == "__main__":
     test_priorities()
+
+
+RULES_METRICS = compile(
+    """
+limit "Limit for adaptor1" (adaptor == "adaptor1") : 2
+user "Per-user limit"      (user ~ ".*") : 1
+"""
+)
+
+
+def test_metrics():
+    broker = Broker(RULES_METRICS, 2, Environment())
+    broker.pause()
+    broker.enqueue_many(SimpleRequest(user) for user in ("alice", "bob", "alice"))
+
+    text = broker.metrics_text()
+    assert 'queueos_requests{status="QUEUED"} 3' in text
+
+    broker.resume()
+    broker.wait_for_all_requests()
+
+    text = broker.metrics_text()
+    assert 'queueos_user_wait_seconds_count{user="alice"} 2' in text
+    assert 'queueos_limit_wait_seconds_count{limit="Limit for adaptor1"} 3' in text
+    assert 'queueos_limit_value{limit="Limit for adaptor1"} 0' in text
+    assert 'queueos_limit_utilization{limit="Limit for adaptor1"} 0.0' in text
+    assert 'queueos_lock_hold_seconds_count{lock="qos"}' in text
+    assert 'queueos_pick_seconds_bucket{le="+Inf"}' in text
+    broker.shutdown()
+
+
+def test_tracer(tmp_path):
+    tracer = Tracer(capacity=100)
+    broker = Broker(RULES_METRICS, 2, Environment(), tracer=tracer)
+    broker.pause()
+    a, b, c = SimpleRequest("alice"), SimpleRequest("alice"), SimpleRequest("bob")
+    broker.enqueue_many([a, b, c])
+    broker.resume()
+    broker.shutdown()
+
+    tracer.dump(tmp_path / "trace")
+    names, records = tracing.load(tmp_path / "trace")
+    assert names == ["Per-user limit"]
+
+    lines = []
+    tracing.explain(names, records, b.id, out=lines.append)
+    assert any(f"overtaken by request {a.id}" in line for line in lines)
+    assert any("blocked by limit Per-user limit" in line for line in lines)
+    assert "completed" in lines[-1]
+
+
+def test_record_and_replay(tmp_path):
+    recorder = Recorder(tmp_path / "workload.csv", attributes=["dataset", "adaptor"])
+    broker = Broker(RULES_METRICS, 2, Environment(), recorder=recorder)
+    requests = [SimpleRequest(user) for user in ("alice", "bob", "alice")]
+    requests.append(FailingRequest("erin"))
+    broker.enqueue_many(requests)
+    broker.shutdown()
+    recorder.close()
+
+    replayer = Replayer(tmp_path / "workload.csv", speed=None, work=None)
+    # The requests were queued at the same time, so their order is not known
+    replayed = {r.user: r for r in replayer.requests}
+    users = sorted(r.user for r in replayer.requests)
+    assert users == ["alice", "alice", "bob", "erin"]
+    assert all(r.dataset == "dataset-1" for r in replayer.requests)
+    assert replayed["bob"].duration >= 0.01
+
+    broker = Broker(RULES_METRICS, 2, Environment())
+    count, _ = replayer.replay(broker)
+    broker.shutdown()
+    assert count == 4
+    assert replayed["bob"].status == Status.COMPLETE
+    assert replayed["erin"].status == Status.ABORTED
+
+
+RULES_PERMISSIONS = compile(
+    """
+permission "No access for erin" (user == "erin") : false
+"""
+)
+
+
+def test_permissions_at_admission():
+    broker = Broker(RULES_PERMISSIONS, 1, Environment())
+    broker.pause()
+    futures = broker.enqueue_many(SimpleRequest(u) for u in ("erin", "david", "erin"))
+
+    # Denied requests never reach the queue
+    assert broker.known_requests == 1
+    for future in (futures[0], futures[2]):
+        assert isinstance(future.exception(timeout=1), RequestCanceled)
+        assert str(future.exception()) == "No access for erin"
+
+    # The outcome of the rules is cached per user
+    assert broker.qos.metrics()["permissions"] == 2
+
+    broker.resume()
+    assert futures[1].result(timeout=5) == "david"
+    broker.shutdown()
+
+
+RULES_QUEUE = compile(
+    """
+queue "Two waiting requests for dataset-2" (dataset == "dataset-2") : 2
+priority "vip" (user == "vip") : 1000
+priority "alice" (user == "alice") : 10
+"""
+)
+
+
+def test_bounded_queue():
+    admission = Admission(max_queued_per_user=2, timeout=0.1)
+    broker = Broker(RULES_QUEUE, 1, Environment(), admission=admission)
+    broker.pause()
+
+    # The per-user bound, with the default 'raise' policy
+    broker.enqueue(SimpleRequest("erin"))
+    broker.enqueue(SimpleRequest("erin"))
+    for policy in (None, BLOCK):
+        try:
+            broker.enqueue(SimpleRequest("erin"), policy=policy)
+            assert False, "QueueFull expected"
+        except QueueFull:
+            pass
+
+    # A 'queue' rule, shedding the request with the lowest priority
+    requests = [SimpleRequest(u) for u in ("alice", "bob", "vip", "carol")]
+    for request in requests:
+        request.dataset = "dataset-2"
+    futures = broker.enqueue_many(requests[:3], policy=SHED)
+    assert isinstance(futures[1].exception(timeout=1), QueueFull)
+    assert isinstance(broker.enqueue(requests[3], policy=SHED).exception(), QueueFull)
+    assert broker.known_requests == 4
+
+    # Wait for room without blocking the event loop
+    async def run():
+        task = asyncio.ensure_future(broker.enqueue_async(SimpleRequest("erin")))
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        broker.resume()
+        future = await task
+        return await future
+
+    admission.timeout = None
+    assert asyncio.run(run()) == "erin"
+    broker.shutdown()
+
+
+RULES_RATE = compile(
+    """
+rate burst 1 "Twenty starts per second" (true) : 20
+"""
+)
+
+
+def test_rate_limits():
+    broker = Broker(RULES_RATE, 5, Environment())
+    requests = [SimpleRequest("david") for _ in range(5)]
+    start = time.time()
+    broker.enqueue_many(requests)
+    broker.wait_for_all_requests()
+
+    # The workers are woken up when a token is available
+    assert time.time() - start < 1
+    starts = sorted(request.time - 0.01 for request in requests)
+    assert all(b - a > 0.04 for a, b in zip(starts, starts[1:]))
+    broker.shutdown()
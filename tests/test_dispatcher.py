@@ -0,0 +1,171 @@
+import io
+from functools import partial
+
+from queueos import Environment
+from queueos.dispatcher.Simulator import SimulatedRequest, Simulator
+from queueos.dispatcher.Timers import Timers
+from queueos.expressions.RulesParser import RulesParser
+from queueos.qos.FairShareQoS import FairShareQoS
+from queueos.qos.QoS import QoS
+from queueos.qos.Rule import RuleSet
+
+environment = Environment()
+
+
+def compile(text):
+    parser = RulesParser(io.StringIO(text))
+    rules = RuleSet()
+    parser.parse_rules(rules, environment)
+    return rules
+
+
+def test_timers_order():
+    timers = Timers()
+    called = []
+    timers.call_at(3, called.append, "c")
+    timers.call_at(1, called.append, "a")
+    timers.call_at(2, called.append, "b")
+    timers.call_at(2, called.append, "b2")
+
+    assert len(timers) == 4
+    assert timers.next_deadline() == 1
+    assert timers.timeout(0.5) == 0.5
+    assert timers.timeout(10) == 0
+
+    assert timers.run_due(2) == 3
+    assert called == ["a", "b", "b2"]
+    assert timers.next_deadline() == 3
+
+
+def test_timers_cancel():
+    timers = Timers()
+    called = []
+    a = timers.call_at(1, called.append, "a")
+    timers.call_at(2, called.append, "b")
+
+    a.cancel()
+    assert timers.next_deadline() == 2
+    assert timers.run_due(5) == 1
+    assert called == ["b"]
+    assert timers.next_deadline() is None
+    assert timers.timeout(0) is None
+
+
+RULES_SIMULATOR = compile(
+    """
+user "Per-user limit" (user ~ ".*") : 1
+priority "Priority for frank" (user == "frank") : 100
+"""
+)
+
+
+def test_simulator():
+    simulator = Simulator(RULES_SIMULATOR, 2, environment)
+    end = simulator.run(
+        [
+            SimulatedRequest(0, 10, "david"),
+            SimulatedRequest(0, 10, "david"),
+            SimulatedRequest(1, 10, "erin"),
+            SimulatedRequest(2, 10, "frank"),
+        ]
+    )
+
+    # Frank overtakes the second request of david
+    assert list(simulator.user_waits["erin"]) == [0]
+    assert list(simulator.user_waits["frank"]) == [8]
+    assert list(simulator.user_waits["david"]) == [0, 11]
+    assert list(simulator.limit_waits["Per-user limit"]) == [0, 0, 8, 11]
+    assert end == 21
+
+
+RULES_SHARES = compile(
+    """
+share "Four times more for david" (user == "david") : 4
+"""
+)
+
+
+def test_fair_share():
+    def workload():
+        return [SimulatedRequest(0, 1, "david") for _ in range(8)] + [
+            SimulatedRequest(0, 1, "erin") for _ in range(3)
+        ]
+
+    # By priority, the oldest requests run first
+    simulator = Simulator(RULES_SHARES, 1, environment)
+    simulator.run(workload())
+    assert list(simulator.user_waits["erin"]) == [8, 9, 10]
+
+    # Erin gets one worker out of five while both users have requests waiting
+    simulator = Simulator(RULES_SHARES, 1, environment, qos_class=FairShareQoS)
+    assert simulator.run(workload()) == 11
+    assert list(simulator.user_waits["david"]) == [0, 2, 3, 4, 6, 7, 8, 9]
+    assert list(simulator.user_waits["erin"]) == [1, 5, 10]
+    assert simulator.qos.metrics()["shares"] == 0
+
+
+RULES_BACKFILL = compile(
+    """
+limit weight estimatedSize() "Cores" (true) : 4
+"""
+)
+
+
+def test_backfill():
+    def workload():
+        return [
+            SimulatedRequest(0, 10, "a", cost=(3, 10)),
+            SimulatedRequest(1, 5, "b", cost=(4, 5)),
+            SimulatedRequest(1, 20, "c", cost=(1, 20)),
+            SimulatedRequest(1, 5, "d", cost=(1, 5)),
+        ]
+
+    # Small requests keep taking the freed cores
+    simulator = Simulator(RULES_BACKFILL, 10, environment)
+    simulator.run(workload())
+    assert [simulator.user_waits[u][0] for u in "bcd"] == [20, 0, 9]
+
+    # Only the requests ending before the reservation of b can run ahead
+    simulator = Simulator(
+        RULES_BACKFILL, 10, environment, qos_class=partial(QoS, backfill=True)
+    )
+    simulator.run(workload())
+    assert [simulator.user_waits[u][0] for u in "bcd"] == [9, 14, 0]
+
+
+RULES_RATE = compile(
+    """
+rate "Two starts per second" (user == "david") : 2
+rate burst 1 "One start per second" (user == "erin") : 1
+"""
+)
+
+
+def test_rate_limits():
+    simulator = Simulator(RULES_RATE, 10, environment)
+    simulator.run(
+        [SimulatedRequest(0, 0.1, "david") for _ in range(6)]
+        + [SimulatedRequest(0, 0.1, "erin") for _ in range(3)]
+    )
+    assert list(simulator.user_waits["david"]) == [0, 0, 0.5, 1, 1.5, 2]
+    assert list(simulator.user_waits["erin"]) == [0, 1, 2]
+
+
+RULES_QUOTA = compile(
+    """
+quota window hour(1) "Half an hour per hour" (user ~ ".*") : minute(30)
+"""
+)
+
+
+def test_quotas():
+    simulator = Simulator(RULES_QUOTA, 10, environment)
+    simulator.run(
+        [SimulatedRequest(0, 1200, "david"), SimulatedRequest(600, 1200, "david")]
+        + [SimulatedRequest(1300, 10, "david"), SimulatedRequest(1300, 10, "erin")]
+    )
+
+    # At 1300, david used 1200s and the running request 700s, so the next
+    # request waits until the usage in the window drops below half an hour
+    assert list(simulator.user_waits["david"]) == [0, 0, 2900]
+    assert list(simulator.user_waits["erin"]) == [0]
@@ -1,8 +1,13 @@
 import io
+import multiprocessing
+import os
 
 from queueos import Environment, FunctionFactory
+from queueos.broker.Request import Request
 from queueos.expressions.RulesParser import RulesParser
+from queueos.qos.QoS import QoS
 from queueos.qos.Rule import RuleSet
+from queueos.qos.SharedCounters import SharedCounters
 
 FunctionFactory.register_function(
     "dataset",
@@ -43,3 +48,272 @@ def compile(text):
 #     )
 #     assert len(rules.user_limits) == 1
 #     assert rules.user_limits[0].match(request)
+
+
+class SharedRequest:
+
+    user = "david"
+    dataset = "dataset-1"
+    adaptor = "adaptor1"
+    cost = (1024 * 1024, 60 * 60 * 24)
+
+
+RULES_SHARED = """
+limit "Limit for adaptor1"  (adaptor == "adaptor1") : 2
+user "Per-user limit"      (user ~ ".*") : 1
+"""
+
+
+def test_shared_counters(tmp_path):
+    name = f"queueos-test-{os.getpid()}"
+    lock = str(tmp_path / "lock")
+    counters1 = SharedCounters(
+        name, counters=64, slots=4, lock_path=lock, lease_check=0
+    )
+    counters2 = SharedCounters(name, counters=64, slots=4, lock_path=lock)
+    try:
+        qos1 = QoS(compile(RULES_SHARED), environment, counters1)
+        qos2 = QoS(compile(RULES_SHARED), environment, counters2)
+
+        a = SharedRequest()
+        qos1.notify_start_of_request(a)
+        # The per-user limit is shared too
+        assert not qos2.can_run(SharedRequest())
+
+        b = SharedRequest()
+        b.user = "erin"
+        qos2.notify_start_of_request(b)
+        assert qos1.rules.global_limits[0].value == 2
+        c = SharedRequest()
+        c.user = "frank"
+        assert not qos1.can_run(c)
+
+        qos1.notify_end_of_request(a)
+        assert qos2.can_run(c)
+
+        # The contributions of a process that died are dropped
+        def crash():
+            counters = SharedCounters(name, counters=64, slots=4, lock_path=lock)
+            counters.counter('limit:"Limit for adaptor1"').add(5)
+            os._exit(0)
+
+        child = multiprocessing.get_context("fork").Process(target=crash)
+        child.start()
+        child.join()
+        assert qos1.rules.global_limits[0].value == 1
+    finally:
+        counters1.close()
+        counters2.close()
+        counters1.unlink()
+
+
+def test_shared_counters_are_released(tmp_path):
+    name = f"queueos-test-{os.getpid()}-released"
+    lock = str(tmp_path / "lock")
+    counters1 = SharedCounters(name, counters=8, slots=2, lock_path=lock)
+    counters2 = SharedCounters(name, counters=8, slots=2, lock_path=lock)
+    try:
+        qos = QoS(compile(RULES_SHARED), environment, counters1)
+        # Held by the other process, so not freed when the QoS evicts it
+        counters2.counter('user:erin:"Per-user limit"').add(1)
+
+        # More distinct users than counters, one after the other
+        for user in ["erin"] + [f"user-{i}" for i in range(20)]:
+            request = SharedRequest()
+            request.user = user
+            qos.prepare([request])
+            assert qos.can_run(request) == (user != "erin")
+            qos.notify_cancel_of_request(request)
+
+        assert qos.metrics()["per_user_limits"] == 0
+        assert counters2.counter('user:erin:"Per-user limit"').value == 1
+    finally:
+        counters1.close()
+        counters2.close()
+        counters1.unlink()
+
+
+RULES_AVAILABLE = """
+permission "Adaptor disabled" (true) : available(adaptor)
+"""
+
+
+def test_permissions_follow_the_environment():
+    qos = QoS(compile(RULES_AVAILABLE), environment)
+
+    def canceled(adaptor):
+        request = SharedRequest()
+        request.canceled = None
+        request.adaptor = adaptor
+        qos.prepare([request])
+        return request.canceled
+
+    assert canceled("adaptor3") is None
+    environment.disable_resource("adaptor3")
+    try:
+        assert canceled("adaptor3") == "Adaptor disabled"
+    finally:
+        environment.enable_resource("adaptor3")
+    assert canceled("adaptor3") is None
+    assert canceled("adaptor2") == "Adaptor disabled"
+
+
+def test_shared_properties():
+    qos = QoS(compile(RULES_SHARED), environment)
+    a, b, c = SharedRequest(), SharedRequest(), SharedRequest()
+    c.user = "erin"
+
+    assert qos.limits_for(a) is qos.limits_for(b)
+    assert qos._properties(a) is qos._properties(b)
+    assert qos._properties(a) is not qos._properties(c)
+    assert len(qos.limits_for(a)) == 2
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class TimedRequest(Request, SharedRequest):
+    pass
+
+
+def test_clock_snapshot():
+    clock = Clock(1000)
+    qos = QoS(compile(RULES_SHARED), environment, clock=clock)
+
+    requests = []
+    for start in (10, 30, 20):
+        request = TimedRequest()
+        request.start = start
+        requests.append(request)
+
+    # The clock is read once per scheduling pass, not once per comparison
+    assert qos.best(requests).start == 10
+    assert clock.now == 1001
+    assert qos.priority(requests[0], 2000) == 1990
+
+
+def test_caches_are_bounded():
+    qos = QoS(compile(RULES_SHARED), environment)
+
+    requests = []
+    for user in ("alice", "bob", "alice"):
+        request = TimedRequest()
+        request.user = user
+        qos.prepare([request])
+        requests.append(request)
+
+    assert qos.metrics()["requests_properties"] == 3
+    assert qos.metrics()["per_user_limits"] == 2
+
+    # A request that never ran
+    qos.notify_cancel_of_request(requests[1])
+    assert qos.metrics()["per_user_limits"] == 1
+
+    qos.notify_start_of_request(requests[0])
+    qos.notify_end_of_request(requests[0])
+    assert qos.metrics()["per_user_limits"] == 1
+
+    qos.notify_cancel_of_request(requests[2])
+    assert qos.metrics() == dict(
+        running_requests=0,
+        requests_properties=0,
+        properties_pool=0,
+        per_user_limits=0,
+        keyed_limits=0,
+        permissions=1,
+    )
+
+
+RULES_WEIGHTED = """
+limit weight estimatedSize() "Bytes in flight" (adaptor == "adaptor1") : mb(3)
+"""
+
+
+def test_weighted_limits():
+    qos = QoS(compile(RULES_WEIGHTED), environment)
+    limit = qos.rules.global_limits[0]
+    assert repr(limit).startswith("limit weight estimatedSize()")
+
+    small, other, large, huge = (TimedRequest() for _ in range(4))
+    large.cost = (2 * 1024 * 1024, 0)
+    huge.cost = (10 * 1024 * 1024, 0)
+
+    # A request heavier than the capacity can run alone
+    assert qos.best([huge]) is huge
+    qos.notify_start_of_request(small)
+    assert limit.value == 1024 * 1024
+
+    # 2 MB fit in the remaining capacity, but 10 MB don't
+    assert qos.best([huge, large]) is large
+    qos.notify_start_of_request(large)
+    assert qos.best([huge, other]) is None
+
+    qos.notify_end_of_request(large)
+    qos.notify_end_of_request(small)
+    assert limit.value == 0
+
+
+RULES_KEYED = """
+limit per dataset() "One per dataset" (adaptor == "adaptor1") : 1
+"""
+
+
+def test_keyed_limits():
+    qos = QoS(compile(RULES_KEYED), environment)
+    assert repr(qos.rules.global_limits[0]).startswith("limit per dataset()")
+
+    a, b, c = TimedRequest(), TimedRequest(), TimedRequest()
+    c.dataset = "dataset-2"
+    qos.prepare([a, b, c])
+    assert qos.limits_for(a) == qos.limits_for(b) != qos.limits_for(c)
+    assert qos.metrics()["keyed_limits"] == 2
+
+    # Each dataset has its own counter
+    qos.notify_start_of_request(a)
+    assert qos.best([b, c]) is c
+
+    # The instances are evicted when no request holds them
+    qos.notify_end_of_request(a)
+    qos.notify_cancel_of_request(b)
+    qos.notify_cancel_of_request(c)
+    assert qos.metrics()["keyed_limits"] == 0
+    assert qos.rules.global_limits[0].instances == {}
+
+
+RULES_REFILLS = """
+rate burst 1 "One start per second" (true) : 1
+quota window minute(1) "Ten seconds per minute" (true) : 10
+"""
+
+
+def test_reload_keeps_buckets_and_ledgers(tmp_path):
+    path = tmp_path / "rules"
+    path.write_text(RULES_REFILLS)
+    now = [1000.0]
+    qos = QoS(str(path), environment, clock=lambda: now[0])
+
+    a, b = TimedRequest(), TimedRequest()
+    assert qos.can_run(a)
+    qos.notify_start_of_request(a)
+    qos.reload_rules()
+    rate, quota = qos.rules.rates[0], qos.rules.quotas[0]
+    assert rate.full(b)
+
+    # The run time of the running request counts towards the quota
+    now[0] += 20
+    assert not rate.full(b)
+    assert quota.full(b)
+
+    qos.notify_end_of_request(a)
+    qos.reload_rules()
+    assert qos.rules.quotas[0] is not quota
+    assert qos.rules.quotas[0].full(b)
+
+    now[0] += 60
+    assert qos.can_run(b)